@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# Times each stage of the pipeline on a fake plate made by SyntheticPlate.py, so changes to the scripts can be
+# checked for speed without a real microscope export. Each stage is run as its own process (the same way we run
+# them by hand), and its wall time, CPU time and peak memory are recorded. Stitching and StarDist are run one well
+# at a time so there are numbers per well as well. The stitched tile positions are also checked against the true
+# ones from SyntheticPlate.py.
+
+# Stages:
+# wellfolders: WellFolders.py on the plate (still run, but not timed, if only stitch or stardist are asked for)
+# stitch: StitchImagesOnGreen.py on each well, registering and fusing in Python (or in Fiji if --imagej is given).
+#         With --jobs above 1, on the whole plate at once with that many wells at a time
+# stardist: StarDistOnIndivFolder.py on each well's green tiles (needs the model, so only if asked for)
+# measure: LabelMeasurements.py on the label images (the true ones from SyntheticPlate.py, unless StarDist ran)
+
+# Call should be in the format:
+# python3 Benchmark.py [path/to/work folder] --wells [number of wells] --tilesize [pixels] --imagej [path/to/imagej] \
+# --jobs [wells to stitch at once] --stages [wellfolders stitch stardist measure] \
+# --results [path/to/results.json] --compare [path/to/earlier results.json] --tolerance [fraction]
+
+# With --compare, each stage is compared to an earlier results file, and stages that got slower by more than
+# --tolerance are listed (and the exit code is 1).
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import SyntheticPlate
+import Telemetry
+from TileFusion import read_tile_configuration
+
+
+scripts = os.path.dirname(os.path.abspath(__file__))
+
+
+# Running a command with its output going to a log file, and getting its wall time, CPU time, peak memory and
+# exit code from the OS when it finishes
+def run_command(command, log_path):
+    with open(log_path, 'ab') as log:
+        log.write(('$ ' + ' '.join(command) + '\n').encode())
+        log.flush()
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = Telemetry.exit_code(status)
+    return {'wall': wall, 'cpu': usage.ru_utime + usage.ru_stime, 'peak_rss_mb': Telemetry.rss_mb(usage.ru_maxrss),
+            'exit': process.returncode}
+
+
+# Adding up the runs of a stage into one record, with the number of items it did per second
+def stage_record(runs, items, unit):
+    wall = sum(run['wall'] for run in runs.values())
+    return {'wall': wall,
+            'cpu': sum(run['cpu'] for run in runs.values()),
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs.values()),
+            'failed': sorted(name for name, run in runs.items() if run['exit'] != 0),
+            'items': items, 'unit': unit, 'per_second': items / max(wall, 1e-9),
+            'runs': runs}
+
+
+# The largest distance in pixels between the registered and the true position of any tile of a well
+def registration_error(plate, well, day, truth):
+    registered = f'{plate}/{well}_Day{day}/Green/{well}TileConGreen.registered.txt'
+    if not os.path.exists(registered):
+        return None
+    positions = [(x, y) for _, x, y in read_tile_configuration(registered)]
+    return max(abs(x - tx) + abs(y - ty) for (x, y), (tx, ty) in zip(positions, truth))
+
+
+# Listing the stages that are slower than in an earlier run by more than the tolerance
+def compare_results(results, earlier, tolerance=0.2):
+    slower = []
+    print(f'{"stage":<14}{"before (s)":>12}{"now (s)":>12}{"change":>10}')
+    for stage, record in results['stages'].items():
+        if stage not in earlier.get('stages', {}):
+            continue
+        before = earlier['stages'][stage]['wall']
+        change = record['wall'] / max(before, 1e-9) - 1
+        flag = '  slower' if change > tolerance else ''
+        print(f'{stage:<14}{before:>12.2f}{record["wall"]:>12.2f}{change:>+10.0%}{flag}')
+        if flag:
+            slower.append(stage)
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times each stage of the pipeline on a synthetic plate',
+                                     usage='%(prog)s WORKFOLDER --wells N --results RESULTS.json '
+                                           '--compare EARLIER.json')
+    parser.add_argument('workfolder', type=str, help='Folder to make the synthetic plate in (emptied first)')
+    parser.add_argument('--wells', type=int, default=4, help='Number of wells on the plate')
+    parser.add_argument('--tilesize', type=int, default=512, help='Width and height of each tile in pixels')
+    parser.add_argument('--nuclei', type=int, default=60, help='Number of nuclei per tile')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the plate')
+    parser.add_argument('--day', type=int, default=3, help='Day to give the plate')
+    parser.add_argument('--stages', type=str, nargs='+', default=['wellfolders', 'stitch', 'measure'],
+                        choices=['wellfolders', 'stitch', 'stardist', 'measure'],
+                        help='Stages to run (stardist is left out by default since it needs the model)')
+    parser.add_argument('--imagej', type=str, default=None,
+                        help='Stitch with this Fiji instead of in Python (Fiji is skipped if not given)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Wells to stitch at once. With more than 1, the whole plate is stitched in one run of '
+                             'the stitching script instead of one run per well')
+    parser.add_argument('--results', type=str, default=None, help='JSON file to save the results to')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier results JSON to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much slower (as a fraction) a stage can get before it is reported')
+    args = parser.parse_args()
+
+    plate = os.path.abspath(args.workfolder)
+    shutil.rmtree(plate, ignore_errors=True)
+    os.makedirs(plate)
+    log_path = plate + '/benchmark.log'
+    wells = SyntheticPlate.well_names(args.wells)
+    stages = {}
+
+    # Making the plate in its own process too, so this one stays small (a process's peak memory counts
+    # whatever it had when it was started from this one)
+    print(f'Making a synthetic plate with {len(wells)} wells in {plate}')
+    run = run_command([sys.executable, f'{scripts}/SyntheticPlate.py', plate, '--wells', str(args.wells),
+                       '--tilesize', str(args.tilesize), '--nuclei', str(args.nuclei), '--seed', str(args.seed),
+                       '--labels', '--day', str(args.day)], log_path)
+    stages['generate'] = stage_record({'plate': run}, len(wells), 'wells')
+    with open(os.path.join(plate, SyntheticPlate.ground_truth_name), 'r') as file:
+        truth = json.load(file)
+    tiles = len(wells) * 12 * len(SyntheticPlate.channels)
+
+    if 'wellfolders' in args.stages:
+        print('Timing WellFolders.py')
+        run = run_command([sys.executable, f'{scripts}/WellFolders.py', plate, str(args.day)], log_path)
+        stages['wellfolders'] = stage_record({'plate': run}, tiles, 'tiles')
+    elif 'stitch' in args.stages or 'stardist' in args.stages:
+        # Stitching and StarDist need the well folders, so they're still made (without timing it)
+        print('Running WellFolders.py')
+        run = run_command([sys.executable, f'{scripts}/WellFolders.py', plate, str(args.day)], log_path)
+        if run['exit'] != 0:
+            raise SystemExit(f'WellFolders.py failed (see {log_path})')
+
+    if 'stitch' in args.stages:
+        print('Timing StitchImagesOnGreen.py' + (' with Fiji' if args.imagej else ' in Python'))
+        if args.imagej:
+            options = ['--imagej', args.imagej, '--firstmacrolocation', f'{scripts}/FirstStitchGreen.ijm',
+                       '--secondmacrolocation', f'{scripts}/SecondStitch.ijm']
+        else:
+            options = ['--registration', 'python', '--fusion', 'python']
+        runs = {}
+        if args.jobs > 1:
+            # --jobs only does anything with more than one well, so the whole plate is stitched in one run
+            runs['plate'] = run_command([sys.executable, f'{scripts}/StitchImagesOnGreen.py', plate, str(args.day),
+                                         '--jobs', str(args.jobs)] + options, log_path)
+        else:
+            for well in wells:
+                runs[well] = run_command([sys.executable, f'{scripts}/StitchImagesOnGreen.py', plate, str(args.day),
+                                          '--wells', well] + options, log_path)
+        stages['stitch'] = stage_record(runs, len(wells), 'wells')
+        # The stitching script carries on past wells it couldn't stitch, so those are found from their images
+        missing = [well for well in wells if not all(os.path.exists(f'{plate}/Stitched_Images_{args.day}/'
+                                                                    f'{well}_{color}_Stitched.tif')
+                                                     for color in ['Red', 'Green'])]
+        stages['stitch']['failed'] = sorted(set(stages['stitch']['failed']) | set(missing))
+        errors = {well: registration_error(plate, well, args.day, truth['positions'][well]) for well in wells}
+        stages['stitch']['registration_error_px_per_well'] = errors
+        errors = [error for error in errors.values() if error is not None]
+        stages['stitch']['registration_error_px'] = max(errors) if errors else None
+
+    if 'stardist' in args.stages:
+        print('Timing StarDistOnIndivFolder.py')
+        # Measuring the StarDist label images instead of the true ones
+        shutil.rmtree(plate + '/labelimages', ignore_errors=True)
+        runs = {}
+        for well in wells:
+            runs[well] = run_command([sys.executable, f'{scripts}/StarDistOnIndivFolder.py',
+                                      f'{plate}/{well}_Day{args.day}/Green'], log_path)
+        stages['stardist'] = stage_record(runs, len(wells) * 12, 'images')
+
+    if 'measure' in args.stages:
+        print('Timing LabelMeasurements.py')
+        if os.path.isdir(f'{plate}/labelimages'):
+            label_folders = {'plate': f'{plate}/labelimages'}
+        else:
+            label_folders = {well: f'{plate}/{well}_Day{args.day}/labelimages' for well in wells}
+        runs = {name: run_command([sys.executable, f'{scripts}/LabelMeasurements.py', folder,
+                                   f'{plate}/measurements.csv', '--plate', 'Synthetic'], log_path)
+                for name, folder in label_folders.items()}
+        stages['measure'] = stage_record(runs, len(wells) * 12, 'images')
+
+    results = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+               'python': platform.python_version(), 'cpus': os.cpu_count(),
+               'options': {'wells': args.wells, 'tilesize': args.tilesize, 'nuclei': args.nuclei, 'seed': args.seed,
+                           'fiji': bool(args.imagej), 'jobs': args.jobs},
+               'stages': stages}
+
+    print(f'{"stage":<14}{"wall (s)":>10}{"cpu (s)":>10}{"peak MB":>10}{"rate":>18}')
+    for stage, record in stages.items():
+        rate = f'{record["per_second"]:.2f} {record["unit"]}/s'
+        print(f'{stage:<14}{record["wall"]:>10.2f}{record["cpu"]:>10.2f}{record["peak_rss_mb"]:>10.0f}{rate:>18}')
+        if record['failed']:
+            print(f'  failed: {", ".join(record["failed"])} (see {log_path})')
+    if stages.get('stitch', {}).get('registration_error_px') is not None:
+        print(f'Largest registration error: {stages["stitch"]["registration_error_px"]:.0f} px')
+
+    if args.results is not None:
+        with open(args.results, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f'Saved the results to {args.results}')
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            slower = compare_results(results, json.load(file), args.tolerance)
+        if slower:
+            print('Slower than before: ' + ', '.join(slower))
+            sys.exit(1)
@@ -0,0 +1,118 @@
+# Runs StarDist on images too large to segment in one go, like whole stitched wells. Normalizing and predicting a
+# whole stitched well at once makes several full-size float copies of it, so instead:
+# - the normalization percentiles are worked out from a histogram built up a few rows at a time (or, for float
+#   images, from a subsample of the pixels), without a float copy of the whole image
+# - StarDist's predict_instances_big() segments the image in overlapping blocks, normalizing each block with those
+#   same percentiles, and joins up the objects that cross the block edges
+# - the labels are written straight into a memory-mapped TIFF as each block finishes
+# so the memory used depends on the block size rather than the size of the well. The stitched image itself is
+# memory-mapped if it's an uncompressed TIFF (otherwise it's read in as it is, without converting it to floats).
+# Images that fit in a single block are segmented in one go with predict_instances(), with the same normalization.
+# Used by the StarDist scripts with --bigimage (see StarDistPipeline.py).
+
+import numpy as np
+import tifffile
+from csbdeep.data import Normalizer
+from csbdeep.utils import normalize_mi_ma
+
+import ResultCache
+
+
+# The given percentiles of an image, the same as np.percentile() gives. Integer images are counted into a histogram
+# a few rows at a time. Other images use every "step"th pixel of every "step"th row
+def image_percentiles(image, percentiles, rows=1024, step=4):
+    if not np.issubdtype(image.dtype, np.integer):
+        return np.percentile(image[::step, ::step], percentiles)
+    offset = int(image.min()) if np.issubdtype(image.dtype, np.signedinteger) else 0
+    counts = np.zeros(0, np.int64)
+    for start in range(0, image.shape[0], rows):
+        block = np.bincount((image[start:start + rows].ravel().astype(np.int64) - offset))
+        if len(block) > len(counts):
+            block[:len(counts)] += counts
+            counts = block
+        else:
+            counts[:len(block)] += block
+    cumulative = np.cumsum(counts)
+    values = []
+    for percentile in np.atleast_1d(percentiles):
+        # Interpolating between the two pixels either side of the rank, like np.percentile's default
+        rank = percentile / 100 * (cumulative[-1] - 1)
+        below = np.searchsorted(cumulative, np.floor(rank), side='right')
+        above = np.searchsorted(cumulative, np.ceil(rank), side='right')
+        values.append(below + (above - below) * (rank - np.floor(rank)) + offset)
+    return np.array(values, dtype=np.float64)
+
+
+# Normalizes each block with percentiles worked out beforehand from the whole image, so every block is scaled the
+# same way it would have been if the whole image had been normalized at once
+class FixedNormalizer(Normalizer):
+    def __init__(self, low, high):
+        self.low = np.float32(low)
+        self.high = np.float32(high)
+
+    def before(self, x, axes):
+        return normalize_mi_ma(x, self.low, self.high, dtype=np.float32)
+
+    def after(self, mean, scale, axes):
+        raise ValueError('FixedNormalizer only normalizes the input')
+
+    @property
+    def do_after(self):
+        return False
+
+
+# Memory-mapping a TIFF if it's stored uncompressed in one piece, or otherwise reading it in as it is
+def open_image(path):
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return tifffile.imread(path)
+
+
+# The block size, overlap and context along each axis of an image for predict_instances_big(). Blocks are no bigger
+# than the image and a multiple of the model's grid. An axis too short for a block to hold the overlap and context
+# on both sides (like the short side of a long strip) is covered by one block the width of the image instead, with
+# no overlap or context along it. Returns None if the image fits in one block (or the blocks are too small for the
+# overlap and context), in which case it's segmented in one go instead
+def block_sizes(shape, grid, block_size=2048, min_overlap=128, context=128):
+    if all(size <= block_size for size in shape):
+        return None
+    sizes, overlaps, contexts = [], [], []
+    for size, step in zip(shape, grid):
+        if size // step * step <= min_overlap + 2 * context:
+            sizes.append(size // step * step)
+            overlaps.append(0)
+            contexts.append(0)
+        else:
+            sizes.append(min(block_size, size) // step * step)
+            overlaps.append(min_overlap)
+            contexts.append(context)
+    if all(overlap == 0 for overlap in overlaps) or \
+            any(size <= overlap + 2 * pad for size, overlap, pad in zip(sizes, overlaps, contexts) if overlap):
+        return None
+    return tuple(sizes), tuple(overlaps), tuple(contexts)
+
+
+# Segmenting one large image block by block, writing its labels into a memory-mapped TIFF at saveloc (atomically,
+# see ResultCache.py). Returns the labels, memory-mapped from the finished file, and the polygons StarDist found
+# (see PolygonStore.py)
+def segment_big_image(model, path, saveloc, lower=40, upper=100, prob_thresh=0.25, nms_thresh=0.3,
+                      block_size=2048, min_overlap=128, context=128):
+    image = open_image(path)
+    low, high = image_percentiles(image, [lower, upper])
+    blocks = block_sizes(image.shape, model.config.grid, block_size, min_overlap, context)
+    with ResultCache.atomic_output(saveloc) as temporary:
+        labels = tifffile.memmap(temporary, shape=image.shape, dtype=np.int32, photometric='minisblack')
+        if blocks is None:
+            labels[:], details = model.predict_instances(image, axes='YX', normalizer=FixedNormalizer(low, high),
+                                                         prob_thresh=prob_thresh, nms_thresh=nms_thresh)
+        else:
+            sizes, overlaps, contexts = blocks
+            _, details = model.predict_instances_big(image, axes='YX', block_size=sizes, min_overlap=overlaps,
+                                                     context=contexts, labels_out=labels,
+                                                     normalizer=FixedNormalizer(low, high), prob_thresh=prob_thresh,
+                                                     nms_thresh=nms_thresh)
+        labels.flush()
+        del labels
+    del image
+    return tifffile.memmap(saveloc, mode='r'), details
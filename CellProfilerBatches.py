@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Splits the image sets of a CellProfiler batch file (Batch_data.h5) into chunks that should each take about the same
+# time, instead of writing the "startimage stopimage" lookup file for CellProfilerTemplate.sh by hand.
+# Each image set is given a cost (the number of pixels in its images, their size on disk, or just 1 per set), and
+# the image sets are cut into contiguous ranges (since CellProfiler's -f/-l take a first and last image set) so that
+# the most expensive range is as cheap as possible.
+
+# It writes the lookup file and, from CellProfilerTemplate.sh, an sbatch script with the matching --array size:
+# python3 CellProfilerBatches.py [path/to/Batch_data.h5] --tasks [number of array tasks] --concurrent [max at once] \
+# --lookup [path/to/Plate001_lookup.txt] --sbatch [path/to/script to write]
+
+# Or it can run CellProfiler on one big node without SLURM. The image sets are cut into several chunks per worker,
+# and each worker takes the next chunk (biggest first) whenever it finishes one, so no worker sits idle while another
+# one works through a slow chunk:
+# python3 CellProfilerBatches.py [path/to/Batch_data.h5] --local --workers [number of CellProfiler processes]
+
+# The image sets are read from the batch file with h5py. If that isn't possible, --imagefolder and --pattern can be
+# used instead to give the images in the order CellProfiler will see them (one image set per matching file).
+
+import argparse
+import glob
+import math
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Getting the files in each image set from the measurements stored in a CellProfiler batch file, as a list (one per
+# image set, in image number order) of lists of file paths
+def image_sets_from_batch_file(batchfile):
+    import h5py
+    from urllib.parse import unquote, urlparse
+
+    with h5py.File(batchfile, 'r') as h5:
+        measurements = h5['Measurements']
+        image = measurements[sorted(measurements.keys())[0]]['Image']
+        features = list(image.keys())
+        urls = [feature for feature in features if feature.startswith('URL_')]
+        if not urls:
+            urls = [feature for feature in features if feature.startswith('FileName_')]
+
+        image_sets = {}
+        for feature in urls:
+            data = image[feature]['data'][()]
+            # Each row of the index is (image number, start, stop) into the data
+            for image_number, start, stop in image[feature]['index'][()]:
+                value = data[start:stop]
+                value = value.tobytes().decode() if hasattr(value, 'tobytes') else str(value)
+                if feature.startswith('URL_'):
+                    path = unquote(urlparse(value).path)
+                else:
+                    folder = image['PathName_' + feature[len('FileName_'):]]
+                    index = folder['index'][()]
+                    row = index[index[:, 0] == image_number][0]
+                    path = os.path.join(folder['data'][row[1]:row[2]].tobytes().decode(), value)
+                image_sets.setdefault(int(image_number), []).append(path)
+    return [image_sets[number] for number in sorted(image_sets)]
+
+
+# Getting the image sets from a folder instead: one image set per file matching the pattern, in name order
+def image_sets_from_folder(folder, pattern):
+    return [[path] for path in sorted(glob.glob(os.path.join(folder, pattern)))]
+
+
+# How expensive an image set should be to analyse: the number of pixels in its images (read from the TIFF headers),
+# their size on disk, or just 1 per image set
+def image_set_cost(paths, cost='pixels'):
+    if cost == 'count':
+        return 1
+    total = 0
+    for path in paths:
+        if not os.path.exists(path):
+            total += 1
+        elif cost == 'pixels':
+            import tifffile
+            with tifffile.TiffFile(path) as tif:
+                total += math.prod(tif.series[0].shape)
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+# Cutting the costs into at most "chunks" contiguous ranges so the most expensive range is as cheap as possible
+# (binary search on that maximum, filling each range greedily). Returns a list of (first, last) image numbers,
+# counting from 1 like CellProfiler does (or no ranges if there are no image sets)
+def partition(costs, chunks):
+    if not costs:
+        return []
+    chunks = max(1, min(chunks, len(costs)))
+
+    def cut(limit):
+        ranges = []
+        start, total = 0, 0
+        for number, cost in enumerate(costs):
+            if total + cost > limit and number > start:
+                ranges.append((start + 1, number))
+                start, total = number, 0
+            total += cost
+        ranges.append((start + 1, len(costs)))
+        return ranges
+
+    low, high = max(costs), sum(costs)
+    while low < high:
+        middle = (low + high) // 2
+        if len(cut(middle)) <= chunks:
+            high = middle
+        else:
+            low = middle + 1
+    return cut(low)
+
+
+def write_lookup(path, ranges):
+    with open(path, 'w') as file:
+        for first, last in ranges:
+            file.write(f'{first} {last}\n')
+
+
+# Making an sbatch script from CellProfilerTemplate.sh with the array size, lookup file and batch file filled in
+def write_sbatch(template, path, tasks, concurrent, lookup, batchfile):
+    with open(template, 'r') as file:
+        script = file.read()
+    script = re.sub(r'--array=\S+', f'--array=1-{tasks}%{concurrent}', script)
+    script = re.sub(r'\S+_lookup\.txt', lookup, script)
+    script = re.sub(r'-p \S+', f'-p {batchfile}', script)
+    with open(path, 'w') as file:
+        file.write(script)
+
+
+# Running CellProfiler headless on each range with a pool of workers. The ranges are handed out biggest first, and
+# each worker takes the next one as soon as it is free. Returns the ranges that failed
+def run_local(cellprofiler, batchfile, ranges, range_costs, workers):
+    order = sorted(range(len(ranges)), key=lambda number: range_costs[number], reverse=True)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        for number in order:
+            first, last = ranges[number]
+            call = [cellprofiler, '-p', batchfile, '-c', '-r', '-f', str(first), '-l', str(last)]
+            running[pool.submit(subprocess.run, call, capture_output=True, text=True)] = (first, last)
+        for future in as_completed(running):
+            first, last = running[future]
+            result = future.result()
+            if result.returncode != 0:
+                failed.append((first, last))
+                print(f'CellProfiler failed on image sets {first}-{last}:\n' +
+                      '\n'.join(result.stderr.splitlines()[-10:]))
+            else:
+                print(f'Done with image sets {first}-{last}')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Splits the image sets of a CellProfiler batch file into chunks of '
+                                                 'about equal cost, for a SLURM array or for running locally',
+                                     usage='%(prog)s BATCHFILE --tasks N --lookup LOOKUPFILE --sbatch SCRIPT '
+                                           '(or BATCHFILE --local --workers N)')
+    parser.add_argument('batchfile', type=str, help='Path of the Batch_data.h5 file')
+    parser.add_argument('--imagefolder', type=str, default=None,
+                        help='Get the image sets from this folder instead of from the batch file')
+    parser.add_argument('--pattern', type=str, default='*.tif', help='Images to use with --imagefolder')
+    parser.add_argument('--cost', type=str, choices=['pixels', 'size', 'count'], default='pixels',
+                        help='What to balance: image pixels, file sizes, or the number of image sets')
+    parser.add_argument('--tasks', type=int, default=16, help='Number of SLURM array tasks')
+    parser.add_argument('--concurrent', type=int, default=8, help='Maximum number of array tasks running at once')
+    parser.add_argument('--lookup', type=str, default='lookup.txt', help='Lookup file to write')
+    parser.add_argument('--template', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CellProfilerTemplate.sh'),
+                        help='sbatch template to fill in')
+    parser.add_argument('--sbatch', type=str, default=None, help='sbatch script to write from the template')
+    parser.add_argument('--local', action='store_true', help='Run CellProfiler here instead of writing SLURM files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='CellProfiler processes with --local')
+    parser.add_argument('--chunksperworker', type=int, default=4,
+                        help='How many chunks to cut the image sets into per worker with --local')
+    parser.add_argument('--cellprofiler', type=str, default='cellprofiler', help='CellProfiler command')
+    args = parser.parse_args()
+
+    if args.imagefolder is not None:
+        image_sets = image_sets_from_folder(args.imagefolder, args.pattern)
+    else:
+        image_sets = image_sets_from_batch_file(args.batchfile)
+    costs = [image_set_cost(paths, args.cost) for paths in image_sets]
+    print(f'Found {len(image_sets)} image sets')
+
+    chunks = args.workers * args.chunksperworker if args.local else args.tasks
+    ranges = partition(costs, chunks)
+    if not ranges:
+        raise SystemExit('No image sets to split')
+    range_costs = [sum(costs[first - 1:last]) for first, last in ranges]
+    print(f'Split into {len(ranges)} chunks, costing from {min(range_costs)} to {max(range_costs)} '
+          f'(average {sum(range_costs) / len(ranges):.0f})')
+
+    if args.local:
+        failed = run_local(args.cellprofiler, args.batchfile, ranges, range_costs, args.workers)
+        if failed:
+            print('Failed image sets: ' + ', '.join(f'{first}-{last}' for first, last in failed))
+    else:
+        write_lookup(args.lookup, ranges)
+        print(f'Wrote {args.lookup}')
+        if args.sbatch is not None:
+            write_sbatch(args.template, args.sbatch, len(ranges), min(args.concurrent, len(ranges)), args.lookup,
+                         args.batchfile)
+            print(f'Wrote {args.sbatch} with --array=1-{len(ranges)}%{min(args.concurrent, len(ranges))}')
@@ -0,0 +1,126 @@
+# Helpers for stitching a whole list of wells in one headless Fiji session instead of starting Fiji (and the JVM
+# and all of its plugins) again for every channel of every well. The stitching scripts describe the steps for each
+# well with the functions below, and run_batches() writes them all into one generated macro and runs it. The
+# stitching steps are copied in from the same macro files the scripts would otherwise run (--firstmacrolocation and
+# --secondmacrolocation), with their "#@" parameters set as variables, so any changes made to those files are kept.
+
+# The generated macro prints a "CRANIUM_START" line before each well and a "CRANIUM_DONE" line once all of its
+# images have been written, each with Fiji's clock in milliseconds so the time spent on each well is known. An error
+# in an ImageJ macro stops the whole macro, so if a well fails the wells after it are sent to a new Fiji session, and
+# the failed well is reported back instead of stopping the whole plate.
+
+import os
+import re
+
+import Telemetry
+
+
+result_regex = re.compile(r'^CRANIUM_(?P<status>START|DONE) (?P<well>\S+)(?: (?P<time>\d+))?')
+
+
+# Making a string safe to put inside double quotes in an ImageJ macro
+def quote(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# The lines of a macro file, without the "#@" lines that declare its parameters
+def macro_lines(macro):
+    with open(macro, 'r') as file:
+        return [line.rstrip('\n') for line in file if not line.lstrip().startswith('#@')]
+
+
+# Running the lines of a macro file with its parameters set as variables first. Everything is closed afterwards,
+# otherwise the displayed images pile up over the whole plate
+def run_macro(macro, **parameters):
+    lines = [f'{name} = {quote(str(value))};' for name, value in parameters.items()]
+    return lines + macro_lines(macro) + ['close("*");']
+
+
+# Registering (and fusing, if the macro writes its output to dir2) a grid of tiles with FirstStitchBF.ijm or
+# FirstStitchGreen.ijm
+def first_stitch(macro, directory, file_names, tilecon, output_directory=None):
+    parameters = {'dir1': directory, 'FileNames': file_names, 'TileCon': tilecon}
+    if output_directory is not None:
+        parameters['dir2'] = output_directory
+    return run_macro(macro, **parameters)
+
+
+# Fusing a set of tiles from an already registered tile configuration file with SecondStitch.ijm
+def second_stitch(macro, directory, tilecon, output_directory):
+    return run_macro(macro, dir1=directory, TileCon=tilecon, dir2=output_directory)
+
+
+# Copying a registration file while swapping the channel in the file names, which the stitching scripts
+# otherwise do in Python between two Fiji calls
+def rewrite_registration(source, destination, old, new):
+    return [f'File.saveString(replace(File.openAsString({quote(source)}), {quote(old)}, {quote(new)}), '
+            f'{quote(destination)});']
+
+
+# Renaming Fiji's fused output ("img_t1_z1_c1") to its final name
+def rename(source, destination):
+    return [f'if (File.rename({quote(source)}, {quote(destination)}) != 1) '
+            f'exit("Could not rename " + {quote(source)});']
+
+
+# Putting together the macro for a list of (well, macro lines) pairs
+def batch_macro(wells):
+    lines = ['setBatchMode(true);']
+    for well, well_lines in wells:
+        lines.append(f'print("CRANIUM_START {well} " + d2s(getTime(), 0));')
+        lines.extend(well_lines)
+        lines.append(f'print("CRANIUM_DONE {well} " + d2s(getTime(), 0));')
+    return '\n'.join(lines) + '\n'
+
+
+# Running one Fiji session on a list of (well, macro lines) pairs, returning the wells that were finished,
+# the well that failed (or None) and Fiji's output. If given a Telemetry object, the session and each well in it are
+# recorded there
+def run_batch(imagej, wells, macro_path, telemetry=None, batch_name='batch'):
+    with open(macro_path, 'w') as file:
+        file.write(batch_macro(wells))
+    call = f'{imagej} --ij2 --headless --run {quote(macro_path)}'
+    record, stdout = Telemetry.run_command(call, keep_stdout=True)
+
+    started = {}
+    finished = []
+    for line in stdout.splitlines():
+        m = result_regex.match(line.strip())
+        if m and m.group('status') == 'START':
+            started[m.group('well')] = m.group('time')
+        elif m:
+            finished.append(m.group('well'))
+            if telemetry is not None and m.group('time') and started.get(m.group('well')):
+                telemetry.record(m.group('well'), 'fiji_batch_well', session=batch_name, exit=0,
+                                 wall=(int(m.group('time')) - int(started[m.group('well')])) / 1000)
+    failed = None
+    if started and list(started)[-1] not in finished:
+        failed = list(started)[-1]
+    elif len(finished) < len(wells):
+        # Fiji stopped without ever starting the next well (e.g. it didn't start at all), so blaming that well
+        failed = wells[len(finished)][0]
+    if telemetry is not None:
+        telemetry.record(batch_name, 'fiji_batch', wells=[well for well, _ in wells], failed=failed, **record)
+        if failed is not None:
+            telemetry.record(failed, 'fiji_batch_well', session=batch_name, exit=1, wall=0.0,
+                             stdout_tail=record['stdout_tail'], stderr_tail=record['stderr_tail'])
+    return finished, failed, stdout + '\n'.join(record['stderr_tail'])
+
+
+# Running a list of (well, macro lines) pairs through as few Fiji sessions as possible. Returns a dictionary of
+# well -> 'done' or 'failed'
+def run_batches(imagej, wells, macro_path, telemetry=None):
+    results = {}
+    remaining = list(wells)
+    batch_name = os.path.splitext(os.path.basename(macro_path))[0].lstrip('_')
+    while remaining:
+        finished, failed, output = run_batch(imagej, remaining, macro_path, telemetry, batch_name)
+        for well in finished:
+            results[well] = 'done'
+        if failed is not None:
+            results[failed] = 'failed'
+            print(f'Fiji failed while stitching {failed}:\n' + '\n'.join(output.splitlines()[-10:]))
+        remaining = [(well, lines) for well, lines in remaining if well not in results]
+    if os.path.exists(macro_path):
+        os.remove(macro_path)
+    return results
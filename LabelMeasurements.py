@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Measures StarDist label images directly, instead of loading them into CellProfiler just to count the nuclei.
+# Gives the same three values per image that the iPSC analysis notebook reads from CellProfiler (Count_labels,
+# AreaOccupied_AreaOccupied_labels and AreaOccupied_TotalArea_labels) along with the plate/well/field/day metadata,
+# with the same column names, so the notebook can read this CSV in place of the CellProfiler one.
+
+# The StarDist scripts use this with --measure to measure each label image while it is still in memory, adding a
+# row to the CSV as each image finishes (and measuring label images that were skipped as up to date if the CSV has no
+# row for them yet). At the end the CSV is left with one row per image, the newest. It can also be run on a
+# "labelimages" folder that has already been made:
+# python3 LabelMeasurements.py [path/to/labelimages] [path/to/output.csv] --plate [plate name]
+# Polygon stores written by the StarDist scripts with --polygons (see PolygonStore.py) are measured too.
+
+import argparse
+import csv
+import glob
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tifffile import imread
+
+import PolygonStore
+import ResultCache
+import WellIndex
+
+
+columns = ['FileName_labels', 'Metadata_Plate', 'Metadata_Well', 'Metadata_Field', 'Metadata_Day',
+           'Count_labels', 'AreaOccupied_AreaOccupied_labels', 'AreaOccupied_TotalArea_labels']
+# The metadata columns that, along with the image the labels were made from, say which image a row is for
+key_columns = columns[1:5]
+day_regex = re.compile(r'_Day(?P<day>\d+)')
+well_regex = re.compile(r'^(?P<well>[A-Z]\d{2})')
+
+
+# The number of objects, the number of pixels covered by them, and the total number of pixels in a label image.
+# (Label numbers don't have to be consecutive, so the objects are counted from the labels that have any pixels).
+# The pixels are counted a few rows at a time, so a memory-mapped label image of a whole well isn't read in at once
+def measure_labels(labels, rows=4096):
+    pixels = np.zeros(1, np.int64)
+    for start in range(0, labels.shape[0], rows):
+        block = np.bincount(np.asarray(labels[start:start + rows]).ravel())
+        if len(block) > len(pixels):
+            block[:len(pixels)] += pixels
+            pixels = block
+        else:
+            pixels[:len(block)] += block
+    return {'Count_labels': int(np.count_nonzero(pixels[1:])),
+            'AreaOccupied_AreaOccupied_labels': int(pixels[1:].sum()),
+            'AreaOccupied_TotalArea_labels': int(labels.size)}
+
+
+# The name of the image that a label image or polygon store was made from, e.g. "A - 01(fld 05 ...).tif" for
+# "A - 01(fld 05 ...)_labels.tif"
+def source_name(path):
+    return os.path.basename(path).replace('_labels.tif', '.tif').replace(PolygonStore.store_suffix, '.tif')
+
+
+# Which image a row is for: the image its labels were made from and its plate, well, field and day. (Not the label
+# file name, so an image segmented again into a polygon store instead of a label image still has one row)
+def row_key(row):
+    return (source_name(row.get('FileName_labels', '')),) + tuple(str(row.get(column, '')) for column in key_columns)
+
+
+# Getting the well, field and day for an image from its file name and folders, e.g.
+# ".../A01_Day3/Green/A - 01(fld 05 wv 488 - GreenHS).tif". The label image's path is checked for the day too,
+# since images from the well index (WellIndex.py) aren't in a "_Day" folder but their label images are
+def image_metadata(image_path, label_path=''):
+    name = source_name(image_path)
+    tile = WellIndex.parse_tile_name(name)
+    if tile is not None:
+        well, field = tile['well'], tile['field']
+    else:
+        m = well_regex.match(name)
+        well, field = (m.group('well') if m else ''), ''
+    days = day_regex.findall(label_path) or day_regex.findall(image_path)
+    return {'Metadata_Well': well, 'Metadata_Field': field, 'Metadata_Day': int(days[-1]) if days else ''}
+
+
+# The rows of a measurements CSV, keeping only the last row for each image (see row_key())
+def read_rows(path):
+    rows = {}
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as file:
+            for row in csv.DictReader(file):
+                rows[row_key(row)] = row
+    return rows
+
+
+# Rewriting a measurements CSV with only the newest row for each image (rows are only ever added while images are
+# being measured, so an image that was measured again has more than one, e.g. after rerunning with --polygons).
+# Only to be done once nothing else is adding rows to it
+def compact_csv(path):
+    rows = read_rows(path)
+    with ResultCache.atomic_output(path) as temporary:
+        with open(temporary, 'w', newline='') as file:
+            writer = csv.DictWriter(file, columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows.values())
+    return len(rows)
+
+
+# Adds one row per label image to a CSV file as they are measured. Each row is added with a single write in append
+# mode, so several threads or processes can share the same CSV. If an image is measured again (e.g. after its label
+# image was remade) a second row is added for it, so once everything is done the CSV is tidied up with
+# compact_csv(), which keeps the newest one
+class MeasurementWriter:
+    def __init__(self, path, plate=''):
+        self.path = path
+        self.plate = plate
+        self.lock = threading.Lock()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'w', newline='') as file:
+                csv.writer(file).writerow(columns)
+        self.measured = set(read_rows(path))
+
+    def row_key(self, image_path, label_path=''):
+        row = {'FileName_labels': os.path.basename(label_path or image_path), 'Metadata_Plate': self.plate}
+        row.update(image_metadata(image_path, label_path))
+        return row_key(row)
+
+    # Whether the CSV already has a row for an image (e.g. one whose label image was skipped as up to date)
+    def has_row(self, image_path, label_path=''):
+        return self.row_key(image_path, label_path) in self.measured
+
+    def add(self, labels, image_path, label_path=''):
+        row = {'FileName_labels': os.path.basename(label_path or image_path),
+               'Metadata_Plate': self.plate}
+        row.update(image_metadata(image_path, label_path))
+        row.update(measure_labels(labels))
+        text = io.StringIO()
+        csv.writer(text).writerow([row[column] for column in columns])
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, text.getvalue().encode())
+            finally:
+                os.close(fd)
+            self.measured.add(self.row_key(image_path, label_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the number of objects and the area they cover in every '
+                                                 'label image in a labelimages folder, and writes them to a CSV',
+                                     usage='%(prog)s LABELFOLDER OUTPUTCSV --plate PLATENAME')
+    parser.add_argument('folderlocation', type=str, help='Path of the labelimages folder')
+    parser.add_argument('output', type=str, help='Path of the CSV to write')
+    parser.add_argument('--plate', type=str, default='', help='Plate name for the Metadata_Plate column')
+    parser.add_argument('--threads', type=int, default=4, help='Number of label images to read at once')
+    args = parser.parse_args()
+
+    writer = MeasurementWriter(args.output, args.plate)
+    labelimages = sorted(glob.glob(args.folderlocation + '/*/*.tif') + glob.glob(args.folderlocation + '/*.tif'))
+    # Polygon stores that don't already have their label image written out next to them
+    labelimages += sorted(path for path in glob.glob(args.folderlocation + '/*/*' + PolygonStore.store_suffix) +
+                          glob.glob(args.folderlocation + '/*' + PolygonStore.store_suffix)
+                          if not os.path.exists(PolygonStore.label_path(path)))
+
+    def measure(path):
+        if path.endswith(PolygonStore.store_suffix):
+            writer.add(PolygonStore.load_labels(path), path, path)
+        else:
+            writer.add(imread(path), path, path)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(measure, labelimages))
+    compact_csv(args.output)
+    print(f'Measured {len(labelimages)} label images into {args.output}')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Writes stitched images as tiled, losslessly compressed (zlib) OME-TIFFs with a pyramid of smaller copies of the
+# image stored alongside it (as SubIFDs, the way Bio-Formats and QuPath expect), instead of one large uncompressed
+# plane. Readers that understand tiles only have to read and decode the parts of the image they need, and viewers
+# can show the smaller copies. Tools that just read the first image in the file (tifffile.imread, CellProfiler,
+# StarDist) still get the full resolution image, so the files keep their usual names.
+
+# The stitching scripts use this with --ometiff. Stitched folders that already exist can be converted in place:
+# python3 OmeTiff.py [path/to/Stitched_Images folder or images] --pattern [*_Stitched.tif] --tile [pixels] \
+# --threads [images to convert at once]
+
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+import ResultCache
+
+
+# Halving the size of an image by averaging each 2x2 block of pixels (dropping the last row/column if it's odd)
+def downsample(image):
+    height, width = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    blocks = image[:height, :width].reshape(height // 2, 2, width // 2, 2)
+    smaller = blocks.mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(image.dtype, np.integer):
+        np.rint(smaller, out=smaller)
+    return smaller.astype(image.dtype)
+
+
+# The image and each smaller copy of it, halving until it fits in min_size (or there are "levels" of them)
+def pyramid(image, levels=None, min_size=512):
+    images = [image]
+    while max(images[-1].shape) > min_size and (levels is None or len(images) < levels) and \
+            min(images[-1].shape) >= 2:
+        images.append(downsample(images[-1]))
+    return images
+
+
+# Writing a 2D image as a tiled, compressed, pyramidal OME-TIFF. It's written under a temporary name and only
+# moved into place once it's finished (see ResultCache.py), so a file can be converted in place
+def write_ome_tiff(path, image, tile=512, compression='zlib', levels=None, min_size=512):
+    images = pyramid(np.asarray(image), levels, min_size)
+    options = dict(tile=(tile, tile), compression=compression, predictor=True, photometric='minisblack')
+    with ResultCache.atomic_output(path) as temporary:
+        with tifffile.TiffWriter(temporary, ome=True, bigtiff=images[0].nbytes > 2 ** 31) as tif:
+            tif.write(images[0], subifds=len(images) - 1, metadata={'axes': 'YX'}, **options)
+            for smaller in images[1:]:
+                tif.write(smaller, subfiletype=1, **options)
+
+
+# Whether a file is already laid out as a tiled, compressed OME-TIFF. Images that fit in min_size don't get a
+# pyramid, so the number of levels isn't checked
+def is_ome_tiff(path):
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        return tif.is_ome and page.is_tiled and page.compression != tifffile.COMPRESSION.NONE
+
+
+# Reading one level of the pyramid (0 is the full image, 1 is half the size and so on)
+def read_level(path, level=0):
+    with tifffile.TiffFile(path) as tif:
+        levels = tif.series[0].levels
+        return levels[min(level, len(levels) - 1)].asarray()
+
+
+# Rewriting a stitched image as an OME-TIFF in place. Returns False if it already was one
+def convert_file(path, tile=512, levels=None, min_size=512):
+    if is_ome_tiff(path):
+        return False
+    write_ome_tiff(path, tifffile.imread(path), tile=tile, levels=levels, min_size=min_size)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts stitched images to tiled, compressed, pyramidal '
+                                                 'OME-TIFFs in place',
+                                     usage='%(prog)s FOLDERPATH [or IMAGES] --pattern PATTERN --tile N --threads N')
+    parser.add_argument('paths', type=str, nargs='+', help='Stitched images folder(s), or the images themselves')
+    parser.add_argument('--pattern', type=str, default='*_Stitched.tif', help='Images to convert in each folder')
+    parser.add_argument('--tile', type=int, default=512, help='Width and height of the TIFF tiles')
+    parser.add_argument('--minsize', type=int, default=512,
+                        help='Keep halving the image for the pyramid until it fits in this many pixels')
+    parser.add_argument('--threads', type=int, default=4, help='Number of images to convert at once')
+    args = parser.parse_args()
+
+    images = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            images += sorted(glob.glob(os.path.join(glob.escape(path), args.pattern)))
+        else:
+            images.append(path)
+
+    def convert(path):
+        before = os.path.getsize(path)
+        if convert_file(path, tile=args.tile, min_size=args.minsize):
+            print(f'Converted {os.path.basename(path)} ({before / 2 ** 20:.0f} MB -> '
+                  f'{os.path.getsize(path) / 2 ** 20:.0f} MB)')
+        else:
+            print(f'Skipping {os.path.basename(path)}, already an OME-TIFF')
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(convert, images))
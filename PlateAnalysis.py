@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# The analysis from the notebooks in Example_Analysis, as functions that work on any number of metrics and plates
+# at once. Instead of loading the whole CellProfiler CSV and then picking a few columns, only the columns that are
+# needed are read (with their types given up front, a chunk at a time), and they are kept in a Parquet file next to
+# the CSV (if pyarrow is installed) so later runs don't read the CSV again. The gene/gRNA layout is joined on once,
+# and the fold change and percent difference vs the control are worked out for every metric, plate and day together.
+
+# The two notebooks become:
+# iPSC plates: fields summed per well, fold change from the first day, then the mean of the wells of each guide
+# python3 PlateAnalysis.py [path/to/iPSCPlate06_final.csv] --genes [Plate06Genes.xlsx] --grnas [Plate06gRNAs.xlsx] \
+# --preset ipsc --exclude B09 B10 --output [path/to/output.csv]
+# Neurons: the mean of all the images of each guide on each day
+# python3 PlateAnalysis.py [path/to/Plate006_Final.csv] --genes [Plate006Genes.xlsx] --grnas [Plate006gRNAs.xlsx] \
+# --preset neuron --output [path/to/output.csv]
+# Several plates can be given at once, each with its own layout: --layout [plate] [genes.xlsx] [grnas.xlsx]
+
+# Or from a notebook:
+# import PlateAnalysis
+# measurements = PlateAnalysis.read_measurements('iPSCPlate06_final.csv', PlateAnalysis.presets['ipsc']['metrics'])
+# layout = PlateAnalysis.read_layout('Plate06Genes.xlsx', 'Plate06gRNAs.xlsx')
+# results = PlateAnalysis.summarize(measurements, layout, **PlateAnalysis.presets['ipsc'])
+# heatmap = PlateAnalysis.heatmap_table(results, 'Count_labels')
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# The metadata columns, by the name used here. They are found in the CSV ignoring case, since some pipelines
+# write "Metadata_day" and others "Metadata_Day"
+metadata_columns = {'Plate': 'Metadata_Plate', 'Well': 'Metadata_Well', 'Field': 'Metadata_Field',
+                    'Day': 'Metadata_Day'}
+metadata_dtypes = {'Plate': 'str', 'Well': 'str', 'Field': 'Int32', 'Day': 'Int32'}
+
+# The metrics and steps used by each of the example notebooks
+presets = {'ipsc': {'metrics': ['Count_labels', 'AreaOccupied_AreaOccupied_labels', 'AreaOccupied_TotalArea_labels'],
+                    'well_agg': 'sum', 'fold_change': True},
+           'neuron': {'metrics': ['Count_soma', 'Math_AreaCoveredPerCell',
+                                  'Mean_soma_ObjectSkeleton_NumberTrunks_NeuriteSkeleton'],
+                      'well_agg': None, 'fold_change': False}}
+
+
+# The column with the label image of each row, as written by LabelMeasurements.py
+image_key = 'FileName_labels'
+# The endings LabelMeasurements.py takes off a label image or polygon store to get the image it was made from
+label_endings = r'(_labels\.tif|_polygons\.npz)$'
+
+
+def parquet_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def cache_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+# Reading the metadata and the given metric columns from a measurements CSV. Returns a DataFrame with the columns
+# Plate, Well, Field, Day and then the metrics (Plate is the file name if the CSV has no Metadata_Plate column).
+# If the same image was measured more than once (e.g. rows added again by "StarDist... --measure" after a rerun)
+# only the last row for it is kept. An image is told apart by its metadata and the image its labels were made from
+# (from FileName_labels) if the CSV has that column, and otherwise only by its metadata when every metadata column is there and filled in
+def read_measurements(csv_path, metrics, chunksize=500000, cache=True):
+    parquet = cache_path(csv_path)
+    if cache and parquet_available() and os.path.exists(parquet) and \
+            os.path.getmtime(parquet) >= os.path.getmtime(csv_path):
+        cached = pd.read_parquet(parquet)
+        if all(metric in cached.columns for metric in metrics):
+            return cached[list(metadata_columns) + list(metrics)]
+
+    header = {column.lower(): column for column in pd.read_csv(csv_path, nrows=0).columns}
+    missing = [metric for metric in metrics if metric.lower() not in header]
+    if missing:
+        raise ValueError(f'{csv_path} has no column(s) {", ".join(missing)}')
+    names = {header[column.lower()]: name for name, column in metadata_columns.items() if column.lower() in header}
+    names.update({header[metric.lower()]: metric for metric in metrics})
+    image_column = header.get(image_key.lower())
+    if image_column is not None:
+        names[image_column] = image_key
+    dtypes = {column: metadata_dtypes.get(name, 'str' if name == image_key else 'float64')
+              for column, name in names.items()}
+
+    chunks = []
+    for chunk in pd.read_csv(csv_path, usecols=list(names), dtype=dtypes, chunksize=chunksize):
+        chunks.append(chunk.rename(columns=names))
+    measurements = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(names.values()))
+    if 'Plate' not in measurements.columns:
+        measurements['Plate'] = os.path.splitext(os.path.basename(csv_path))[0]
+    measurements = drop_remeasured(measurements)
+    for name in metadata_columns:
+        if name not in measurements.columns:
+            measurements[name] = pd.array([pd.NA] * len(measurements), dtype=metadata_dtypes[name])
+    measurements = measurements[list(metadata_columns) + list(metrics)]
+    measurements['Plate'] = measurements['Plate'].astype('category')
+    measurements['Well'] = measurements['Well'].astype('category')
+
+    if cache and parquet_available():
+        measurements.to_parquet(parquet, index=False)
+    return measurements
+
+
+# Keeping only the last row of each image that was measured more than once. With a label file name column, rows are
+# the same image if their metadata columns and the images their labels were made from match (so a label image and
+# a polygon store of the same image count as the same image). Without it, rows are only ever dropped if every
+# metadata column is in the CSV, and rows missing any of their metadata are all kept, since they can't be told apart
+def drop_remeasured(measurements):
+    key = [name for name in metadata_columns if name in measurements.columns]
+    if image_key in measurements.columns:
+        source = measurements[image_key].str.replace(label_endings, '.tif', regex=True)
+        duplicated = pd.concat([measurements[key], source], axis=1).duplicated(keep='last')
+        return measurements[~duplicated].reset_index(drop=True)
+    if len(key) < len(metadata_columns):
+        return measurements
+    complete = measurements[key].notna().all(axis=1)
+    duplicated = measurements[key].duplicated(keep='last') & complete
+    return measurements[~duplicated].reset_index(drop=True)
+
+
+# Reading several CSVs into one table
+def read_plates(csv_paths, metrics, chunksize=500000, cache=True):
+    tables = [read_measurements(path, metrics, chunksize, cache) for path in csv_paths]
+    measurements = pd.concat(tables, ignore_index=True)
+    measurements['Plate'] = measurements['Plate'].astype('category')
+    measurements['Well'] = measurements['Well'].astype('category')
+    return measurements
+
+
+# Reading the gene and gRNA of each well from the plate layout spreadsheets (the "vertical" sheet, with the well
+# in the first column and the gene or gRNA in the second). Given a plate name, the layout only applies to that plate
+def read_layout(genes_path, grnas_path, sheet_name='vertical', plate=None):
+    genes = pd.read_excel(genes_path, sheet_name=sheet_name).iloc[:, :2]
+    grnas = pd.read_excel(grnas_path, sheet_name=sheet_name).iloc[:, :2]
+    genes.columns = ['Well', 'Gene']
+    grnas.columns = ['Well', 'grna']
+    layout = genes.merge(grnas, how='outer', on='Well')
+    layout['FullName'] = layout['Gene'] + '_' + layout['grna']
+    if plate is not None:
+        layout.insert(0, 'Plate', plate)
+    return layout
+
+
+# Working out, for every metric, the mean per plate, guide and day, and its percent difference from the control
+# guide on the same plate and day.
+# well_agg: how to combine the images (fields) of each well first ('sum' or 'mean'), or None to use every image
+# fold_change: divide each well's values by its values on the plate's first day before taking the means
+# exclude: wells to leave out
+# Returns a long table with the columns Plate, FullName, Gene, grna, Day, Metric, Value and PercentDifference
+def summarize(measurements, layout, metrics, well_agg='sum', fold_change=True, control='NT_g2', exclude=()):
+    metrics = list(metrics)
+    table = measurements[~measurements['Well'].isin(list(exclude))]
+    if well_agg is not None:
+        table = table.groupby(['Plate', 'Well', 'Day'], observed=True)[metrics].agg(well_agg).reset_index()
+    else:
+        table = table[['Plate', 'Well', 'Day'] + metrics]
+    table = table.astype({'Plate': 'str', 'Well': 'str'})
+
+    if fold_change:
+        first_day = table.groupby('Plate')['Day'].transform('min')
+        baseline = table[table['Day'] == first_day].groupby(['Plate', 'Well'])[metrics].first()
+        baseline = baseline.reindex(pd.MultiIndex.from_frame(table[['Plate', 'Well']]))
+        table[metrics] = table[metrics].to_numpy() / baseline.to_numpy()
+
+    on = ['Plate', 'Well'] if 'Plate' in layout.columns else ['Well']
+    table = table.merge(layout, how='inner', on=on)
+    means = table.groupby(['Plate', 'FullName', 'Gene', 'grna', 'Day'])[metrics].mean().reset_index()
+
+    controls = means.loc[means['FullName'] == control, ['Plate', 'Day'] + metrics]
+    controls = controls.set_index(['Plate', 'Day']).reindex(pd.MultiIndex.from_frame(means[['Plate', 'Day']]))
+    values = means[metrics].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = (values - controls.to_numpy()) / controls.to_numpy() * 100
+
+    keys = ['Plate', 'FullName', 'Gene', 'grna', 'Day']
+    results = means[keys].loc[np.repeat(means.index, len(metrics))].reset_index(drop=True)
+    results['Metric'] = np.tile(metrics, len(means))
+    results['Value'] = values.ravel()
+    results['PercentDifference'] = percent.ravel()
+    return results
+
+
+# Getting a guide x day table of one metric for one plate, ready for a heatmap, with the control as the first row
+def heatmap_table(results, metric, plate=None, control='NT_g2', values='PercentDifference'):
+    rows = results[results['Metric'] == metric]
+    if plate is not None:
+        rows = rows[rows['Plate'] == plate]
+    table = rows.pivot_table(values=values, index='FullName', columns='Day', aggfunc='mean')
+    order = [control] + sorted(name for name in table.index if name != control)
+    return table.reindex(index=[name for name in order if name in table.index])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Works out the fold change and percent difference vs the control '
+                                                 'guide for measurements from one or more plates',
+                                     usage='%(prog)s CSV [CSV ...] --genes GENES.xlsx --grnas GRNAS.xlsx '
+                                           '--preset [ipsc/neuron] --output OUTPUT.csv')
+    parser.add_argument('csvs', type=str, nargs='+', help='Measurement CSVs (CellProfiler or LabelMeasurements.py)')
+    parser.add_argument('--genes', type=str, default=None, help='Gene layout spreadsheet for all of the plates')
+    parser.add_argument('--grnas', type=str, default=None, help='gRNA layout spreadsheet for all of the plates')
+    parser.add_argument('--layout', type=str, nargs=3, action='append', default=[],
+                        metavar=('PLATE', 'GENES', 'GRNAS'), help='Gene and gRNA layout spreadsheets for one plate')
+    parser.add_argument('--sheet', type=str, default='vertical', help='Sheet of the layout spreadsheets to use')
+    parser.add_argument('--preset', type=str, choices=list(presets), default='ipsc',
+                        help='Metrics and steps from one of the example notebooks')
+    parser.add_argument('--metrics', type=str, nargs='+', default=None, help='Columns to use instead of the preset\'s')
+    parser.add_argument('--wellagg', type=str, choices=['sum', 'mean', 'none'], default=None,
+                        help='How to combine the fields of each well (defaults to the preset\'s)')
+    parser.add_argument('--foldchange', action='store_const', const=True, default=None,
+                        help='Use the fold change from the first day (defaults to the preset\'s)')
+    parser.add_argument('--nofoldchange', dest='foldchange', action='store_const', const=False,
+                        help='Use the values themselves instead of the fold change (defaults to the preset\'s)')
+    parser.add_argument('--control', type=str, default='NT_g2', help='Control guide, as Gene_grna')
+    parser.add_argument('--exclude', type=str, nargs='+', default=[], help='Wells to leave out')
+    parser.add_argument('--chunksize', type=int, default=500000, help='Rows of the CSVs to read at a time')
+    parser.add_argument('--nocache', action='store_true', help='Don\'t read or write the Parquet copies of the CSVs')
+    parser.add_argument('--output', type=str, required=True, help='CSV to write the results to')
+    args = parser.parse_args()
+
+    options = dict(presets[args.preset])
+    if args.metrics is not None:
+        options['metrics'] = args.metrics
+    if args.wellagg is not None:
+        options['well_agg'] = None if args.wellagg == 'none' else args.wellagg
+    if args.foldchange is not None:
+        options['fold_change'] = args.foldchange
+
+    if args.layout:
+        layout = pd.concat([read_layout(genes, grnas, args.sheet, plate) for plate, genes, grnas in args.layout],
+                           ignore_index=True)
+    elif args.genes is not None and args.grnas is not None:
+        layout = read_layout(args.genes, args.grnas, args.sheet)
+    else:
+        parser.error('either --genes and --grnas, or --layout, are needed')
+
+    measurements = read_plates(args.csvs, options['metrics'], args.chunksize, not args.nocache)
+    print(f'Read {len(measurements)} rows from {len(args.csvs)} CSVs')
+    results = summarize(measurements, layout, control=args.control, exclude=args.exclude, **options)
+    results.to_csv(args.output, index=False)
+    print(f'Wrote {len(results)} rows to {args.output}')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Keeps what StarDist actually found in each image (the outline of each nucleus as a star-convex polygon, its center
+# and its probability) instead of only a full-size label image. Each image gets one small compressed ".npz" file
+# ("..._polygons.npz" in place of "..._labels.tif") with one array per column:
+# coord  - the polygon of each nucleus, (nuclei, 2, rays) y/x coordinates in pixels
+# points - the center of each nucleus, (nuclei, 2) y/x
+# prob   - the probability of each nucleus
+# shape  - the height and width of the image
+# labels - (optional) the label image itself, as uint16 (or uint32 if there are more labels than fit), which the
+#          .npz compresses
+# Nucleus n (counting from 0) is label n + 1 in the label image, the same as in the labels from StarDist.
+
+# The StarDist scripts write these with --polygons (and leave the label image out of them with --nolabels). A label
+# image can be made again from the polygons at any time with rasterize() or load_labels(), without StarDist. To
+# write label TIFFs again from every store in a labelimages folder (e.g. for CellProfiler):
+# python3 PolygonStore.py [path/to/labelimages] --threads [number of images at once]
+
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+import ResultCache
+
+
+store_suffix = '_polygons.npz'
+
+
+# The polygon store that goes in place of a label image, e.g. "..._labels.tif" -> "..._polygons.npz"
+def store_path(label_path):
+    base = os.path.splitext(label_path)[0]
+    if base.endswith('_labels'):
+        base = base[:-len('_labels')]
+    return base + store_suffix
+
+
+# The label image that a polygon store can be turned back into
+def label_path(path):
+    return path[:-len(store_suffix)] + '_labels.tif'
+
+
+# Saving the details from StarDist's predict_instances() for one image (and its label image, if given). Written
+# under a temporary name and only moved into place once it's finished (see ResultCache.py)
+def save_polygons(path, details, shape, labels=None):
+    columns = {'coord': np.asarray(details['coord'], np.float32),
+               'points': np.asarray(details['points'], np.int32),
+               'prob': np.asarray(details['prob'], np.float32),
+               'shape': np.asarray(shape[:2], np.int64)}
+    if labels is not None:
+        labels = np.asarray(labels)
+        columns['labels'] = labels.astype(np.uint16 if labels.max(initial=0) <= np.iinfo(np.uint16).max
+                                          else np.uint32)
+    with ResultCache.atomic_output(path) as temporary:
+        with open(temporary, 'wb') as file:
+            np.savez_compressed(file, **columns)
+
+
+# Reading a polygon store as a dictionary of its columns
+def load_polygons(path):
+    with np.load(path) as store:
+        return {name: store[name] for name in store.files}
+
+
+# Painting polygons into a label image, nucleus n as label n + 1. Where nuclei overlap, the more probable one is
+# painted last and wins, like StarDist does. A pixel is inside a polygon if its center is (even-odd rule, the same as
+# skimage.draw.polygon which StarDist uses), so the label image matches StarDist's
+def rasterize(coord, shape, prob=None):
+    coord = np.asarray(coord, np.float64)
+    labels = np.zeros(shape, np.int32)
+    order = np.argsort(prob, kind='stable') if prob is not None else range(len(coord))
+    for n in order:
+        y, x = coord[n]
+        top, bottom = max(int(np.ceil(y.min())), 0), min(int(np.floor(y.max())), shape[0] - 1)
+        left, right = max(int(np.ceil(x.min())), 0), min(int(np.floor(x.max())), shape[1] - 1)
+        if top > bottom or left > right:
+            continue
+        # Each edge (from each corner to the one before it) crossed by each row, and where along the row it crosses
+        rows = np.arange(top, bottom + 1, dtype=np.float64)[:, None]
+        y0, x0, y1, x1 = y, x, np.roll(y, 1), np.roll(x, 1)
+        crosses = (y0 > rows) != (y1 > rows)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at = (x1 - x0) * (rows - y0) / (y1 - y0) + x0
+        columns = np.arange(left, right + 1, dtype=np.float64)
+        inside = np.count_nonzero(crosses[:, None, :] & (columns[None, :, None] < at[:, None, :]), axis=2) % 2 == 1
+        labels[top:bottom + 1, left:right + 1][inside] = n + 1
+    return labels
+
+
+# The label image of a polygon store, either the one saved in it or painted from its polygons
+def load_labels(path):
+    store = load_polygons(path)
+    if 'labels' in store:
+        return store['labels']
+    return rasterize(store['coord'], tuple(store['shape']), store['prob'])
+
+
+# Writing the label image of a polygon store as a compressed label TIFF next to it. Returns the TIFF's path
+def write_label_tiff(path):
+    labels = load_labels(path)
+    saveloc = label_path(path)
+    with ResultCache.atomic_output(saveloc) as temporary:
+        tifffile.imwrite(temporary, labels.astype(np.uint16 if labels.max(initial=0) <= np.iinfo(np.uint16).max
+                                                  else np.uint32), compression='zlib')
+    return saveloc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the label images of the polygon stores in a labelimages '
+                                                 'folder as compressed TIFFs',
+                                     usage='%(prog)s LABELFOLDER --threads N')
+    parser.add_argument('folderlocation', type=str, help='Path of the labelimages folder (or of one of its folders)')
+    parser.add_argument('--threads', type=int, default=4, help='Number of label images to write at once')
+    args = parser.parse_args()
+
+    stores = sorted(glob.glob(args.folderlocation + '/*/*' + store_suffix) +
+                    glob.glob(args.folderlocation + '/*' + store_suffix))
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(write_label_tiff, stores))
+    print(f'Wrote {len(stores)} label images in {args.folderlocation}')
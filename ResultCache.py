@@ -0,0 +1,86 @@
+# Keeps track of which outputs (label images, stitched images) are up to date, so that re-running a script only redoes
+# the outputs that are missing or out of date instead of crashing or starting again from scratch.
+
+# Each output folder gets a ".cranium_manifest.jsonl" file. Every time an output is finished, a line is added with a
+# key made from its inputs (size and modification time of each input file, or a hash of their contents) and the
+# parameters it was made with. An output is up to date if it exists and the last line for it has the same key that
+# the inputs and parameters give now. Lines are only ever appended, so several processes can share a manifest.
+# Outputs should be written with atomic_output() so that a half-written file never shows up under its real name.
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+
+manifest_name = '.cranium_manifest.jsonl'
+
+
+# The size and modification time of a file, or a hash of its contents if content_hash is True
+def file_signature(path, content_hash=False):
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Manifest:
+    def __init__(self, folder, content_hash=False):
+        self.folder = os.path.abspath(folder)
+        self.path = os.path.join(self.folder, manifest_name)
+        self.content_hash = content_hash
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    # Skipping any line that was cut off (e.g. if a run was killed part way through writing it)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['output']] = entry['key']
+
+    # Outputs are stored relative to the manifest's folder, so the folder can be moved
+    def name(self, output):
+        return os.path.relpath(os.path.abspath(output), self.folder)
+
+    # Making the key for a list of input files and a dictionary of parameters. Should be worked out before the
+    # output is made, so that inputs that change while it is being made don't get recorded as up to date
+    def key(self, inputs, params):
+        signatures = {os.path.abspath(path): file_signature(path, self.content_hash) for path in inputs}
+        description = json.dumps({'inputs': signatures, 'params': params}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def is_current(self, output, key):
+        return os.path.exists(output) and self.entries.get(self.name(output)) == key
+
+    def record(self, output, key):
+        name = self.name(output)
+        line = json.dumps({'output': name, 'key': key}) + '\n'
+        with self.lock:
+            self.entries[name] = key
+            # One write with O_APPEND, so lines from different processes don't get mixed up
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+
+
+# Gives a temporary path next to path to write to, and moves it into place only once it has been written completely
+@contextmanager
+def atomic_output(path):
+    folder, name = os.path.split(path)
+    temporary = os.path.join(folder, f'.{name}.{os.getpid()}.{threading.get_ident()}.partial')
+    try:
+        yield temporary
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
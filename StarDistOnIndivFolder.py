@@ -14,18 +14,59 @@ from csbdeep.io import save_tiff_imagej_compatible
 from stardist import _draw_polygons, export_imagej_rois
 from stardist.models import StarDist2D
 
+import Telemetry
+from LabelMeasurements import compact_csv
+from StarDistPipeline import segment_images
+
 
 # Getting the location of the folder from the command line:
 parser = argparse.ArgumentParser(description='Uses StarDist to create label images for all of the images '
                                              'in a directory, keeping them grouped as they are in the parent folder',
                                  usage='%(prog)s FOLDERPATH')
 parser.add_argument("folderlocation", type=str, help="Path of the folder with images")
+parser.add_argument("--prefetch", type=int, default=4,
+                    help="How many images to read and normalize ahead of the model")
+parser.add_argument("--writequeue", type=int, default=4,
+                    help="How many label images can be waiting to be saved before the model waits for the writer")
+parser.add_argument("--readers", type=int, default=2, help="Number of threads reading images")
+parser.add_argument("--hash", action="store_true",
+                    help="Decide whether label images are up to date from a hash of each image's contents, instead of "
+                         "its size and modification time")
+parser.add_argument("--measure", type=str, default=None, metavar="CSV",
+                    help="Also count the nuclei and the area they cover in each label image, adding a row per image "
+                         "to this CSV (same columns as the CellProfiler output, see LabelMeasurements.py)")
+parser.add_argument("--plate", type=str, default='', help="Plate name for the Metadata_Plate column of --measure")
+parser.add_argument("--telemetry", type=str, default=None,
+                    help="Where to record the time and memory used to read, segment and save each image (defaults "
+                         "to telemetry.jsonl in the labelimages folder, see Telemetry.py)")
+parser.add_argument("--bigimage", action="store_true",
+                    help="Segment each image on its own in overlapping blocks, writing the labels straight to disk, "
+                         "for images too large to segment in one go like whole stitched wells "
+                         "(see BlockSegmentation.py)")
+parser.add_argument("--blocksize", type=int, default=2048, help="Width and height of each block with --bigimage")
+parser.add_argument("--minoverlap", type=int, default=128,
+                    help="Overlap between blocks with --bigimage, larger than the biggest nucleus")
+parser.add_argument("--context", type=int, default=128,
+                    help="Extra pixels around each block that the model sees with --bigimage")
+parser.add_argument("--polygons", action="store_true",
+                    help="Keep the polygons, centers and probabilities StarDist found in a small _polygons.npz file "
+                         "in place of each label image (see PolygonStore.py). Can't be used with --bigimage")
+parser.add_argument("--nolabels", action="store_true",
+                    help="With --polygons, leave the label image out of the file (it can be made again from the "
+                         "polygons)")
 args = parser.parse_args()
+# (The polygons StarDist finds block by block aren't numbered like the labels it writes, so they can't be
+# kept with --bigimage)
+if args.polygons and args.bigimage:
+    parser.error('--polygons can\'t be used with --bigimage')
+if args.nolabels and not args.polygons:
+    parser.error('--nolabels only works with --polygons')
 
 # Making the output folder in the parent directory if it doesn't exist
 outputfolder = os.path.dirname(args.folderlocation) + '/labelimages'
-if not os.path.exists(outputfolder):
-    os.makedirs(outputfolder)
+os.makedirs(outputfolder, exist_ok=True)
+telemetry = Telemetry.Telemetry(args.telemetry or outputfolder + '/' + Telemetry.telemetry_name,
+                                'StarDistOnIndivFolder')
 
 # Instantiating the StarDist model. Using the '2D_versatile_fluo' pre-trained model. I tried several settings on
 # the images and found that these parameters work best:
@@ -37,13 +78,22 @@ model = StarDist2D.from_pretrained('2D_versatile_fluo')
 folder = args.folderlocation
 print(f'Working on {folder}')
 outdir = outputfolder + '/' + os.path.basename(folder) + '_labels'
-os.makedirs(outdir)
+os.makedirs(outdir, exist_ok=True)
 greenimagesnames = sorted(glob.glob(folder + '/*.tif'))
-greenimages = map(imread, greenimagesnames)
-for tif, loc in zip(greenimages, greenimagesnames):
-    saveloc = outdir + '/' + os.path.splitext(os.path.basename(loc))[0] + '_labels.tif'
-    img = normalize(tif, 40, 100, axis=(0, 1))
-    labels, _ = model.predict_instances(img, prob_thresh=0.25, nms_thresh=0.3)
-    save_tiff_imagej_compatible(saveloc, labels, axes='YX')
-
-print(f'Done with {folder}.')
\ No newline at end of file
+savelocs = [outdir + '/' + os.path.splitext(os.path.basename(loc))[0] + '_labels.tif' for loc in greenimagesnames]
+
+# Reading/normalizing the next images and saving the finished label images in the background while the model runs,
+# skipping any label images that are already up to date from an earlier run (see ResultCache.py)
+block_options = dict(block_size=args.blocksize, min_overlap=args.minoverlap,
+                     context=args.context) if args.bigimage else None
+done, seconds = segment_images(model, greenimagesnames, savelocs, prefetch=args.prefetch,
+                               write_queue=args.writequeue, readers=args.readers,
+                               cache_folder=outputfolder, content_hash=args.hash,
+                               measure_csv=args.measure, plate=args.plate, telemetry=telemetry,
+                               block_options=block_options, polygons=args.polygons,
+                               dense_labels=not args.nolabels)
+# Leaving the CSV with one row per label image (see LabelMeasurements.py)
+if args.measure is not None:
+    compact_csv(args.measure)
+
+print(f'Done with {folder}. {done} images in {seconds:.1f} s ({done / max(seconds, 1e-9):.2f} images/s)')
@@ -0,0 +1,164 @@
+# Runs StarDist over a list of images while overlapping the disk I/O with the model. Upcoming images are read and
+# normalized by a small pool of reader threads (at most "prefetch" images ahead), and the label images are saved by
+# a background writer thread (with at most "write_queue" of them waiting to be written), so the model is kept busy
+# instead of waiting on TIFF decoding and encoding. Used by StarDistOnParentFolder.py and StarDistOnIndivFolder.py.
+# If given a cache folder, images whose label images are already up to date (see ResultCache.py) are skipped, and
+# the label images are written atomically and recorded in that folder's manifest. If given a CSV file, each label
+# image is also measured (see LabelMeasurements.py) while it is still in memory and a row is added to the CSV.
+# If given a Telemetry object (see Telemetry.py), the reading, prediction and writing of each image are recorded.
+# If given block options, each image is instead segmented on its own in overlapping blocks with its labels written
+# straight to disk (see BlockSegmentation.py), for images too large to hold several float copies of, like whole
+# stitched wells.
+# With polygons=True, the polygons StarDist found are kept in a small "_polygons.npz" file in place of each label
+# image (see PolygonStore.py), with the label image in it as well unless dense_labels=False. This can't be done
+# along with block options, since the polygons found block by block aren't numbered like the labels written out.
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from tifffile import imread
+from csbdeep.utils import normalize
+from csbdeep.io import save_tiff_imagej_compatible
+
+import BlockSegmentation
+import PolygonStore
+import ResultCache
+from LabelMeasurements import MeasurementWriter, image_metadata
+
+
+# Reading an image and normalizing it with the percentiles that work best for our images (see the StarDist scripts)
+def read_and_normalize(path, lower=40, upper=100):
+    return normalize(imread(path), lower, upper, axis=(0, 1))
+
+
+# Reading a finished label image (or the labels of a polygon store) back in, e.g. to measure it
+def read_labels(saveloc):
+    if saveloc.endswith(PolygonStore.store_suffix):
+        return PolygonStore.load_labels(saveloc)
+    return BlockSegmentation.open_image(saveloc)
+
+
+# The well (and day, if known) an image is from, to group its telemetry by
+def well_name(path, saveloc):
+    metadata = image_metadata(path, saveloc)
+    if metadata['Metadata_Day'] == '':
+        return metadata['Metadata_Well']
+    return f"{metadata['Metadata_Well']}_Day{metadata['Metadata_Day']}"
+
+
+# Making label images for each image in image_paths, saving them to the matching path in save_paths. A Manifest
+# (for cache_folder) and a MeasurementWriter (for measure_csv) that are already open can be passed in instead, so
+# callers that segment many small lists of images (like the StarDistSharded.py workers) only read them once.
+# Returns the number of images done and how many seconds it took
+def segment_images(model, image_paths, save_paths, prefetch=4, write_queue=4, readers=2,
+                   lower=40, upper=100, prob_thresh=0.25, nms_thresh=0.3, cache_folder=None, content_hash=False,
+                   measure_csv=None, plate='', telemetry=None, block_options=None, polygons=False,
+                   dense_labels=True, manifest=None, measurements=None):
+    start = time.perf_counter()
+
+    # Timing one step for one image, if there is telemetry to record it in
+    def timed(path, saveloc, stage, process_cpu=False):
+        if telemetry is None:
+            return nullcontext()
+        return telemetry.stage(well_name(path, saveloc), stage, process_cpu, image=os.path.basename(path))
+
+    if polygons and block_options is not None:
+        raise ValueError('Polygons can\'t be kept when segmenting in blocks')
+    if measurements is None and measure_csv is not None:
+        measurements = MeasurementWriter(measure_csv, plate)
+    if manifest is None and cache_folder is not None:
+        manifest = ResultCache.Manifest(cache_folder, content_hash)
+    if polygons:
+        save_paths = [PolygonStore.store_path(saveloc) for saveloc in save_paths]
+    jobs = [(path, saveloc, None) for path, saveloc in zip(image_paths, save_paths)]
+    if manifest is not None:
+        params = {'model': getattr(model, 'name', None), 'normalize': [lower, upper],
+                  'prob_thresh': prob_thresh, 'nms_thresh': nms_thresh}
+        if block_options is not None:
+            params['blocks'] = block_options
+        if polygons:
+            params['polygons'] = 'with labels' if dense_labels else 'without labels'
+        jobs = [(path, saveloc, manifest.key([path], params)) for path, saveloc, _ in jobs]
+        current = [manifest.is_current(saveloc, key) for _, saveloc, key in jobs]
+        skipped = [job for job, up_to_date in zip(jobs, current) if up_to_date]
+        todo = [job for job, up_to_date in zip(jobs, current) if not up_to_date]
+        if skipped:
+            print(f'Skipping {len(skipped)} images with up to date label images')
+        # Measuring the skipped label images that aren't in the CSV yet (e.g. when writing to a new CSV)
+        if measurements is not None:
+            for path, saveloc, _ in skipped:
+                if not measurements.has_row(path, saveloc):
+                    measurements.add(read_labels(saveloc), path, saveloc)
+        jobs = todo
+    if block_options is not None:
+        return segment_in_blocks(model, jobs, lower, upper, prob_thresh, nms_thresh, block_options, manifest,
+                                 measurements, timed), time.perf_counter() - start
+    jobs = iter(jobs)
+    reading = deque()
+    writing = deque()
+    done = 0
+
+    # Saving a label image (or polygon store) under a temporary name and only then moving it into place (and into
+    # the manifest), and measuring it
+    def save_labels(path, saveloc, labels, details, key):
+        with timed(path, saveloc, 'stardist_write'):
+            if polygons:
+                PolygonStore.save_polygons(saveloc, details, labels.shape, labels if dense_labels else None)
+            else:
+                with ResultCache.atomic_output(saveloc) as temporary:
+                    save_tiff_imagej_compatible(temporary, labels, axes='YX')
+            if measurements is not None:
+                measurements.add(labels, path, saveloc)
+        if manifest is not None:
+            manifest.record(saveloc, key)
+
+    with ThreadPoolExecutor(max_workers=max(1, readers)) as read_pool, \
+            ThreadPoolExecutor(max_workers=1) as write_pool:
+        def read(path, saveloc):
+            with timed(path, saveloc, 'stardist_read'):
+                return read_and_normalize(path, lower, upper)
+
+        # Keeping up to "prefetch" images being read ahead of the model
+        def queue_reads():
+            while len(reading) < max(1, prefetch):
+                job = next(jobs, None)
+                if job is None:
+                    return
+                reading.append((read_pool.submit(read, job[0], job[1]), job[0], job[1], job[2]))
+
+        queue_reads()
+        while reading:
+            image, path, saveloc, key = reading.popleft()
+            queue_reads()
+            image = image.result()
+            # TensorFlow uses its own threads, so the whole process's CPU time is counted for the prediction
+            with timed(path, saveloc, 'stardist_predict', process_cpu=True):
+                labels, details = model.predict_instances(image, prob_thresh=prob_thresh, nms_thresh=nms_thresh)
+            writing.append(write_pool.submit(save_labels, path, saveloc, labels, details if polygons else None, key))
+            # Waiting on the writer if it has fallen too far behind, so finished label images don't pile up
+            while len(writing) > max(0, write_queue):
+                writing.popleft().result()
+            done += 1
+        for write in writing:
+            write.result()
+
+    return done, time.perf_counter() - start
+
+
+# Segmenting each image of a list of (image, label image, manifest key) jobs one at a time, block by block. The label
+# image is written as it goes. Returns the number of images done
+def segment_in_blocks(model, jobs, lower, upper, prob_thresh, nms_thresh, block_options, manifest, measurements,
+                      timed):
+    for path, saveloc, key in jobs:
+        with timed(path, saveloc, 'stardist_blocks', process_cpu=True):
+            labels, _ = BlockSegmentation.segment_big_image(model, path, saveloc, lower, upper, prob_thresh,
+                                                            nms_thresh, **block_options)
+        if measurements is not None:
+            measurements.add(labels, path, saveloc)
+        del labels
+        if manifest is not None:
+            manifest.record(saveloc, key)
+    return len(jobs)
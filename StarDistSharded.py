@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Does the same job as StarDistOnParentFolder.py (label images for every green image in the subfolders of a folder,
+# written to a "labelimages" folder that mirrors them), but splits the work up between several worker processes.
+# Each worker loads the '2D_versatile_fluo' model once and then keeps taking folders (or chunks of images) until
+# everything is done. TensorFlow in each worker is limited to its own share of the cores (and, where the OS allows
+# it, pinned to them) so the workers don't fight over the same cores.
+
+# Call should be in the format:
+# python3 StarDistSharded.py [path/to/folder] --workers [number of processes] --threads [threads per process] \
+# --shard [folders or images] --chunksize [images per chunk when sharding by images] --index [day]
+
+import os
+import argparse
+import glob
+import multiprocessing
+import time
+
+import ResultCache
+import Telemetry
+import WellIndex
+from LabelMeasurements import MeasurementWriter, compact_csv
+
+
+# Set up in each worker process by start_worker()
+model = None
+manifest = None
+measurements = None
+
+
+# Runs once in each worker: limiting the number of threads, pinning the worker to its own cores, loading the model
+# and reading the manifest and measurement CSV (once, rather than for every shard)
+def start_worker(counter, threads, cache_folder=None, content_hash=False, measure_csv=None, plate=''):
+    global model, manifest, measurements
+    with counter.get_lock():
+        worker_number = counter.value
+        counter.value += 1
+
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (worker_number * threads) % len(cores)
+        os.sched_setaffinity(0, cores[first:first + threads] or cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from stardist.models import StarDist2D
+    model = StarDist2D.from_pretrained('2D_versatile_fluo')
+    if cache_folder is not None:
+        manifest = ResultCache.Manifest(cache_folder, content_hash)
+    if measure_csv is not None:
+        measurements = MeasurementWriter(measure_csv, plate)
+
+
+# Making the label images for one shard (a list of images and where their label images go)
+def run_shard(shard):
+    from StarDistPipeline import segment_images
+    greenimagesnames, savelocs, pipeline_options = shard
+    return segment_images(model, greenimagesnames, savelocs, manifest=manifest, measurements=measurements,
+                          **pipeline_options)
+
+
+if __name__ == '__main__':
+    # Getting the location of the folder from the command line:
+    parser = argparse.ArgumentParser(description='Uses StarDist to create label images for all of the images in the '
+                                                 'subfolders of a directory, split between several processes',
+                                     usage='%(prog)s FOLDERPATH --workers N --threads N --shard [folders/images]')
+    parser.add_argument("folderlocation", type=str, help="Path of the folder with images")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (defaults to the number of cores / --threads)")
+    parser.add_argument("--threads", type=int, default=4, help="Number of TensorFlow threads for each worker")
+    parser.add_argument("--shard", type=str, choices=['folders', 'images'], default='images',
+                        help="Give the workers whole folders or chunks of images")
+    parser.add_argument("--chunksize", type=int, default=8, help="Number of images per chunk with --shard images")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="How many images each worker reads and normalizes ahead of the model")
+    parser.add_argument("--writequeue", type=int, default=4,
+                        help="How many label images can be waiting to be saved in each worker")
+    parser.add_argument("--readers", type=int, default=1, help="Number of threads reading images in each worker")
+    parser.add_argument("--hash", action="store_true",
+                        help="Decide whether label images are up to date from a hash of each image's contents, "
+                             "instead of its size and modification time")
+    parser.add_argument("--index", type=int, default=None, metavar="DAY",
+                        help="Use the green images of this day from the well index made by \"WellFolders.py --index\" "
+                             "(in FOLDERPATH) instead of the subfolders")
+    parser.add_argument("--measure", type=str, default=None, metavar="CSV",
+                        help="Also count the nuclei and the area they cover in each label image, adding a row per image "
+                             "to this CSV (same columns as the CellProfiler output, see LabelMeasurements.py)")
+    parser.add_argument("--plate", type=str, default='', help="Plate name for the Metadata_Plate column of --measure")
+    parser.add_argument("--telemetry", type=str, default=None,
+                        help="Where to record the time and memory used to read, segment and save each image (defaults "
+                             "to telemetry.jsonl in the labelimages folder, see Telemetry.py)")
+    parser.add_argument("--bigimage", action="store_true",
+                        help="Segment each image on its own in overlapping blocks, writing the labels straight to "
+                             "disk, for images too large to segment in one go like whole stitched wells "
+                             "(see BlockSegmentation.py)")
+    parser.add_argument("--blocksize", type=int, default=2048, help="Width and height of each block with --bigimage")
+    parser.add_argument("--minoverlap", type=int, default=128,
+                        help="Overlap between blocks with --bigimage, larger than the biggest nucleus")
+    parser.add_argument("--context", type=int, default=128,
+                        help="Extra pixels around each block that the model sees with --bigimage")
+    parser.add_argument("--polygons", action="store_true",
+                        help="Keep the polygons, centers and probabilities StarDist found in a small _polygons.npz "
+                             "file in place of each label image (see PolygonStore.py). Can't be used with --bigimage")
+    parser.add_argument("--nolabels", action="store_true",
+                        help="With --polygons, leave the label image out of the file (it can be made again from the "
+                             "polygons)")
+    args = parser.parse_args()
+    # (The polygons StarDist finds block by block aren't numbered like the labels it writes, so they can't be
+    # kept with --bigimage)
+    if args.polygons and args.bigimage:
+        parser.error('--polygons can\'t be used with --bigimage')
+    if args.nolabels and not args.polygons:
+        parser.error('--nolabels only works with --polygons')
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = max(1, args.threads)
+    workers = args.workers if args.workers is not None else max(1, cores // threads)
+
+    # Getting a list of the folders in the folder supplied, and then adding an output folder that will mirror
+    # the structure
+    folders = sorted(os.path.join(args.folderlocation, folder) for folder in os.listdir(args.folderlocation)
+                     if os.path.isdir(os.path.join(args.folderlocation, folder)) and folder != 'labelimages')
+    outputfolder = os.path.abspath(args.folderlocation + '/labelimages')
+    os.makedirs(outputfolder, exist_ok=True)
+    # Getting the images in each folder (or, with --index, each well's green tiles from the well index)
+    if args.index is not None:
+        folderimages = WellIndex.tiles_by_well(args.folderlocation, args.index, 'Green')
+    else:
+        folderimages = {os.path.basename(folder): sorted(glob.glob(folder + '/*.tif')) for folder in folders}
+
+    # Splitting the images up into shards, either one per folder or chunks of --chunksize images
+    # (Label images that are already up to date from an earlier run are skipped by the workers, see ResultCache.py)
+    # (The telemetry is sent to the workers along with the options, so their records all share one run id)
+    telemetry = Telemetry.Telemetry(args.telemetry or outputfolder + '/' + Telemetry.telemetry_name, 'StarDistSharded')
+    pipeline_options = dict(prefetch=args.prefetch, write_queue=args.writequeue, readers=args.readers,
+                            cache_folder=outputfolder, content_hash=args.hash, measure_csv=args.measure,
+                            plate=args.plate, telemetry=telemetry, polygons=args.polygons,
+                            dense_labels=not args.nolabels)
+    if args.bigimage:
+        pipeline_options['block_options'] = dict(block_size=args.blocksize, min_overlap=args.minoverlap,
+                                                 context=args.context)
+    if args.measure is not None:
+        # Writing the CSV header before the workers start adding rows to it
+        MeasurementWriter(args.measure, args.plate)
+    shards = []
+    for folder, greenimagesnames in folderimages.items():
+        outdir = outputfolder + '/' + folder + '_labels'
+        os.makedirs(outdir, exist_ok=True)
+        savelocs = [outdir + '/' + os.path.splitext(os.path.basename(loc))[0] + '_labels.tif'
+                    for loc in greenimagesnames]
+        size = len(greenimagesnames) if args.shard == 'folders' else max(1, args.chunksize)
+        for start in range(0, len(greenimagesnames), max(1, size)):
+            shards.append((greenimagesnames[start:start + size], savelocs[start:start + size], pipeline_options))
+
+    print(f'Segmenting {sum(len(shard[0]) for shard in shards)} images from {len(folderimages)} folders in '
+          f'{len(shards)} shards with {workers} workers ({threads} threads each)')
+    start = time.perf_counter()
+    # Using "spawn" so that each worker starts up its own TensorFlow instead of inheriting the parent's
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+    done = 0
+    with context.Pool(workers, initializer=start_worker,
+                      initargs=(counter, threads, outputfolder, args.hash, args.measure, args.plate)) as pool:
+        for shard_done, _ in pool.imap_unordered(run_shard, shards):
+            done += shard_done
+    seconds = time.perf_counter() - start
+    # Leaving the CSV with one row per label image, now that the workers have stopped adding to it
+    if args.measure is not None:
+        compact_csv(args.measure)
+
+    print(f'Done. {done} images in {seconds:.1f} s ({done / max(seconds, 1e-9):.2f} images/s)')
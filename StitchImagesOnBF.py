@@ -10,7 +10,10 @@
 
 # Call should be in the format:
 # python3 StitchImages.py [path/to/folder] [day] --firstmacrolocation [path/to/FirstStitchBF.ijm] \
-# --secondmacrolocation [path/to/SecondStitch.ijm] --imagej [path/to/imagej] --wells [A01 A02 etc.]
+# --secondmacrolocation [path/to/SecondStitch.ijm] --imagej [path/to/imagej] --wells [A01 A02 etc.] \
+# --jobs [number of wells to stitch at once] --memory [total GB for Fiji] --jvmmemory [GB per Fiji process] --batch \
+# --fusion [fiji or python] --registration [fiji or python] --hash --trustexisting --index \
+# --telemetry [path/to/telemetry.jsonl] --ometiff
 
 # The only things hard-coded in that may need to be changed are the location of ImageJ (on line 56),
 # and the default location of your 1st/2nd macros on lines 48 and 51 if you don't want to have to specify every time.
@@ -18,17 +21,26 @@
 import argparse
 import os
 import re
-import subprocess
+from types import SimpleNamespace
+
+import FijiBatch
+import ResultCache
+import StitchWells
+import Telemetry
+import WellIndex
 
 
 # Making a class for each folder that contains red and green image folders. Basically takes a DirEntry object
-# from os.scandir() and adds some convenience attributes
+# from os.scandir() and adds some convenience attributes. With flat=True the tiles haven't been moved into
+# folders (see WellIndex.py), so every color is in the plate folder itself
 class WellFolder:
-    def __init__(self, folder):
+    def __init__(self, folder, flat=False):
         self.folderpath = folder.path
         self.bf_dir = folder.path + '/Brightfield'
         self.red_dir = folder.path + '/Red'
         self.green_dir = folder.path + '/Green'
+        if flat:
+            self.bf_dir = self.red_dir = self.green_dir = folder.path
         self.well = folder.name[:3]
         self.row = folder.name[0]
         self.column = folder.name[1:3]
@@ -55,90 +67,205 @@ parser.add_argument('--wells', type=str, nargs='*', default='all', help='Wells t
 parser.add_argument('--imagej', type=str,
                     default='/Applications/Fiji.app/Contents/MacOS/ImageJ-macosx',
                     help='Absolute path to ImageJ/Fiji')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='Number of wells to stitch at the same time (each one runs its own Fiji process)')
+parser.add_argument('--memory', type=float, default=None,
+                    help='Total memory budget in GB for all of the Fiji processes. Limits --jobs so that '
+                         '(jobs x --jvmmemory) never goes over this')
+parser.add_argument('--jvmmemory', type=float, default=None,
+                    help='Maximum heap in GB for each Fiji process (passed on to Fiji as --mem)')
+parser.add_argument('--batch', action='store_true',
+                    help='Stitch all of the wells in one Fiji session (or one per --jobs) instead of starting Fiji '
+                         'for every channel of every well')
+parser.add_argument('--fusion', type=str, choices=['fiji', 'python'], default='fiji',
+                    help='Fuse the red and green channels with Fiji (SecondStitch.ijm) or with TileFusion.py, '
+                         'which applies the brightfield registration to both channels at once without Fiji')
+parser.add_argument('--registration', type=str, choices=['fiji', 'python'], default='fiji',
+                    help='Register the brightfield tiles with Fiji (the first macro) or with TileRegistration.py, '
+                         'which uses phase correlation on the known 4x3 grid and doesn\'t need Fiji')
+parser.add_argument('--hash', action='store_true',
+                    help='Decide whether stitched images are up to date from a hash of the tiles\' contents, instead '
+                         'of their sizes and modification times')
+parser.add_argument('--trustexisting', action='store_true',
+                    help='Treat stitched images made before there was a manifest in the output folder as up to date '
+                         '(as long as both images for the well exist)')
+parser.add_argument('--index', action='store_true',
+                    help='Use the well index made by "WellFolders.py --index" instead of well folders')
+parser.add_argument('--telemetry', type=str, default=None,
+                    help='Where to record the time, memory and exit status of each step of each well (defaults to '
+                         'telemetry.jsonl in the output folder, see Telemetry.py)')
+parser.add_argument('--ometiff', action='store_true',
+                    help='Write the stitched images as tiled, compressed, pyramidal OME-TIFFs (same file names, '
+                         'see OmeTiff.py)')
 args = parser.parse_args()
+if args.fusion == 'python':
+    import TileFusion
+if args.registration == 'python':
+    import TileRegistration
 
-# Making the shared output folder. If it already exists and some wells have already been stitched,
-# this will make a list of already stitched images in order to avoid doing them again
+# Making the shared output folder. If it already exists and some wells have already been stitched, the folder's
+# manifest (see ResultCache.py) is used to skip them. A well only counts as done if both of its stitched images were
+# finished from the same tiles and settings as now, so half-written or out of date images get stitched again
 output_folder = args.folderlocation + f'/Stitched_Images_{args.day}'
-existing_well_images = []
-try:
-    os.makedirs(output_folder)
-except FileExistsError:
-    existing_well_images = {pic[:3] for pic in os.listdir(output_folder)}
-    pass
+os.makedirs(output_folder, exist_ok=True)
+manifest = ResultCache.Manifest(output_folder, content_hash=args.hash)
+stitch_params = {'script': 'StitchImagesOnBF', 'registration': args.registration, 'fusion': args.fusion}
+if args.ometiff:
+    stitch_params['ometiff'] = True
+telemetry = Telemetry.Telemetry(args.telemetry or f'{output_folder}/{Telemetry.telemetry_name}', 'StitchImagesOnBF')
 
 # Making a list of the folders with pics to stitch:
-# First getting all wells folders:
+# First getting all wells folders (or, with --index, the wells in the index, which all point at the plate folder):
 regex = re.compile(r'^[A-H]\d{2}_Day\d$')
-wanted_folders = [file for file in os.scandir(args.folderlocation) if file.is_dir() and regex.match(file.name)]
+if args.index:
+    wanted_folders = [SimpleNamespace(path=args.folderlocation, name=f'{well}_Day{args.day}')
+                      for well in WellIndex.wells(args.folderlocation, args.day)]
+else:
+    wanted_folders = [file for file in os.scandir(args.folderlocation) if file.is_dir() and regex.match(file.name)]
 # Then filtering them if the --wells tag was used
 if args.wells != 'all':
     passed_wells = [m[0] + m[1:].zfill(2) for m in args.wells]
     wanted_folders = [folder for folder in wanted_folders if folder.name[:3] in passed_wells]
 
-# Looping through the well folders and stitching the images:
-for folder in wanted_folders:
-    well_obj = WellFolder(folder)
-    if well_obj.well in existing_well_images:
-        print(f'Skipping well {well_obj.well}, stitched images already exist')
+# Working out how many wells can be stitched at once (see StitchWells.py)
+jobs, imagej = StitchWells.fiji_jobs(args.imagej, args.jobs, args.memory, args.jvmmemory)
+
+
+# Registering the brightfield tiles of a well in Python (with --registration python)
+def register_well(well_obj):
+    print(f'Registering the brightfield images for {well_obj.well}')
+    with telemetry.stage(well_obj.well, 'register'):
+        TileRegistration.register_well(well_obj.bf_dir, well_obj.row + ' - ' + well_obj.column +
+                                       '(fld {ii} wv TL-Brightfield - Orange).tif', well_obj.well + 'TileConBF.txt')
+
+
+# Fusing the red and green channels of a well in Python from the brightfield registration file, then moving
+# them into the shared output folder
+def fuse_well(well_obj, well_output_folder):
+    print(f'Fusing the red and green images for {well_obj.well}')
+    registrationfile = f'{well_obj.bf_dir}/{well_obj.well}TileConBF.registered.txt'
+    channels = [(well_obj.red_dir, 'TL-Brightfield', '561',
+                 f'{well_output_folder}/{well_obj.well}_Red_Stitched.tif'),
+                (well_obj.green_dir, 'TL-Brightfield - Orange', '488 - GreenHS',
+                 f'{well_output_folder}/{well_obj.well}_Green_Stitched.tif')]
+    with telemetry.stage(well_obj.well, 'fuse'):
+        TileFusion.fuse_registered(registrationfile, channels, args.ometiff)
+    for _, _, _, fused in channels:
+        os.rename(fused, f'{output_folder}/{os.path.basename(fused)}')
+
+
+# Stitching all the channels for a single well, in its own temporary output folder (see StitchWells.py) that is
+# emptied into the shared output folder with the final names
+def stitch_well(well_obj):
+    # Creating some variables to pass on to the ImageJ macros:
+    bf_format = well_obj.row + ' - ' + well_obj.column + '(fld {ii} wv TL-Brightfield - Orange).tif'
+    registrationfile1 = well_obj.well + 'TileConBF.txt'
+    registrationfile2 = well_obj.well + 'TileConBF.registered.txt'
+    registrationfile3 = well_obj.well + 'TileConRed.registered.txt'
+    registrationfile4 = well_obj.well + 'TileConGreen.registered.txt'
+    end_file_name = 'img_t1_z1_c1'
+    well_output_folder = stitcher.well_output_folder(well_obj)
+    os.makedirs(well_output_folder, exist_ok=True)
+
+    # Putting together the parts of the first call to stitch the Brightfield images:
+    initial1 = str(f'{imagej} --ij2 '
+                   f'--headless --run {args.firstmacrolocation} ')
+    passed_vars1 = str(f'\'dir1="{well_obj.bf_dir}",FileNames="{bf_format}",'
+                       f'TileCon="{registrationfile1}"\'')
+    full_call1 = initial1 + passed_vars1
+
+    # Running the macro to stitch the Brightfield channel (or registering it in Python with --registration python).
+    # Fiji's time, memory, exit code and output are recorded (see Telemetry.py), and a failed call raises an error
+    if args.registration == 'python':
+        register_well(well_obj)
     else:
-        # Creating some variables to pass on to the ImageJ macros:
-        bf_format = well_obj.row + ' - ' + well_obj.column + '(fld {ii} wv TL-Brightfield - Orange).tif'
-        registrationfile1 = well_obj.well + 'TileConBF.txt'
-        registrationfile2 = well_obj.well + 'TileConBF.registered.txt'
-        registrationfile3 = well_obj.well + 'TileConRed.registered.txt'
-        registrationfile4 = well_obj.well + 'TileConGreen.registered.txt'
-        end_file_name = 'img_t1_z1_c1'
-
-        # Putting together the parts of the first call to stitch the Brightfield images:
-        initial1 = str(f'{args.imagej} --ij2 '
-                       f'--headless --run {args.firstmacrolocation} ')
-        passed_vars1 = str(f'\'dir1="{well_obj.bf_dir}",FileNames="{bf_format}",'
-                           f'TileCon="{registrationfile1}"\'')
-        quiet = str(' >/dev/null 2>&1')
-        full_call1 = initial1 + passed_vars1 + quiet
-
-        # Running the macro to stitch the Brightfield channel:
         print(f'Stitching the brightfield images for {well_obj.well}')
-        subprocess.run(full_call1, shell=True)
-
-        # Altering the output registration text file to make it use red and green images file names,
-        # and writing it to the red and green folders
-        with open(f'{well_obj.bf_dir}/{registrationfile2}', 'r') as file:
-            filedata = file.read()
-        filedata_red = filedata.replace('TL-Brightfield', '561')
-        filedata_green = filedata.replace('TL-Brightfield - Orange', '488 - GreenHS')
-        with open(f'{well_obj.red_dir}/{registrationfile3}', 'w') as file:
-            file.write(filedata_red)
-        with open(f'{well_obj.green_dir}/{registrationfile4}', 'w') as file:
-            file.write(filedata_green)
-
-        # Putting together the parts of the second call to stitch the red images:
-        initial2 = str(f'{args.imagej} --ij2 '
-                       f'--headless --run {args.secondmacrolocation} ')
-        passed_vars2 = str(f'\'dir1="{well_obj.red_dir}",TileCon="{registrationfile3}",'
-                           f'dir2="{output_folder}"\'')
-        full_call2 = initial2 + passed_vars2 + quiet
-
-        # Running the macro to stitch the Red channel:
-        print(f'Stitching the red images for {well_obj.well}')
-        subprocess.run(full_call2, shell=True)
-
-        # Changing the name of the output file
-        os.rename(f'{output_folder}/{end_file_name}', f'{output_folder}/{well_obj.well}_Red_Stitched.tif')
-
-        # Putting together the parts of the third call to stitch the green images:
-        initial3 = str(f'{args.imagej} --ij2 '
-                       f'--headless --run {args.secondmacrolocation} ')
-        passed_vars3 = str(f'\'dir1="{well_obj.green_dir}",TileCon="{registrationfile4}",'
-                           f'dir2="{output_folder}"\'')
-        full_call3 = initial3 + passed_vars3 + quiet
-
-        # Running the macro to stitch the green channel:
-        print(f'Stitching the green images for {well_obj.well}')
-        subprocess.run(full_call3, shell=True)
-
-        # Changing the name of the output file
-        os.rename(f'{output_folder}/{end_file_name}', f'{output_folder}/{well_obj.well}_Green_Stitched.tif')
+        record = telemetry.run(full_call1, well_obj.well, 'fiji_brightfield')
+        StitchWells.check_fiji_output(f'{well_obj.bf_dir}/{registrationfile2}', record)
+
+    # With --fusion python, both channels are fused straight from the brightfield registration
+    if args.fusion == 'python':
+        fuse_well(well_obj, well_output_folder)
+        return
+
+    # Altering the output registration text file to make it use red and green images file names,
+    # and writing it to the red and green folders
+    with open(f'{well_obj.bf_dir}/{registrationfile2}', 'r') as file:
+        filedata = file.read()
+    filedata_red = filedata.replace('TL-Brightfield', '561')
+    filedata_green = filedata.replace('TL-Brightfield - Orange', '488 - GreenHS')
+    with open(f'{well_obj.red_dir}/{registrationfile3}', 'w') as file:
+        file.write(filedata_red)
+    with open(f'{well_obj.green_dir}/{registrationfile4}', 'w') as file:
+        file.write(filedata_green)
+
+    # Putting together the parts of the second call to stitch the red images:
+    initial2 = str(f'{imagej} --ij2 '
+                   f'--headless --run {args.secondmacrolocation} ')
+    passed_vars2 = str(f'\'dir1="{well_obj.red_dir}",TileCon="{registrationfile3}",'
+                       f'dir2="{well_output_folder}"\'')
+    full_call2 = initial2 + passed_vars2
+
+    # Running the macro to stitch the Red channel:
+    print(f'Stitching the red images for {well_obj.well}')
+    record = telemetry.run(full_call2, well_obj.well, 'fiji_red')
+
+    # Changing the name of the output file
+    StitchWells.move_fiji_image(f'{well_output_folder}/{end_file_name}',
+                                f'{output_folder}/{well_obj.well}_Red_Stitched.tif', record)
+
+    # Putting together the parts of the third call to stitch the green images:
+    initial3 = str(f'{imagej} --ij2 '
+                   f'--headless --run {args.secondmacrolocation} ')
+    passed_vars3 = str(f'\'dir1="{well_obj.green_dir}",TileCon="{registrationfile4}",'
+                       f'dir2="{well_output_folder}"\'')
+    full_call3 = initial3 + passed_vars3
+
+    # Running the macro to stitch the green channel:
+    print(f'Stitching the green images for {well_obj.well}')
+    record = telemetry.run(full_call3, well_obj.well, 'fiji_green')
+
+    # Changing the name of the output file
+    StitchWells.move_fiji_image(f'{well_output_folder}/{end_file_name}',
+                                f'{output_folder}/{well_obj.well}_Green_Stitched.tif', record)
+
+
+# The same steps as stitch_well(), written out as ImageJ macro lines for --batch mode
+def batch_steps(well_obj):
+    bf_format = well_obj.row + ' - ' + well_obj.column + '(fld {ii} wv TL-Brightfield - Orange).tif'
+    registrationfile1 = well_obj.well + 'TileConBF.txt'
+    registrationfile2 = well_obj.well + 'TileConBF.registered.txt'
+    registrationfile3 = well_obj.well + 'TileConRed.registered.txt'
+    registrationfile4 = well_obj.well + 'TileConGreen.registered.txt'
+    end_file_name = 'img_t1_z1_c1'
+    well_output_folder = stitcher.well_output_folder(well_obj)
+    os.makedirs(well_output_folder, exist_ok=True)
+
+    steps = []
+    if args.registration == 'fiji':
+        steps += FijiBatch.first_stitch(args.firstmacrolocation, well_obj.bf_dir, bf_format, registrationfile1)
+    if args.fusion == 'python':
+        # The fusion is done afterwards by fuse_well()
+        return steps
+    steps += FijiBatch.rewrite_registration(f'{well_obj.bf_dir}/{registrationfile2}',
+                                            f'{well_obj.red_dir}/{registrationfile3}', 'TL-Brightfield', '561')
+    steps += FijiBatch.rewrite_registration(f'{well_obj.bf_dir}/{registrationfile2}',
+                                            f'{well_obj.green_dir}/{registrationfile4}',
+                                            'TL-Brightfield - Orange', '488 - GreenHS')
+    steps += FijiBatch.second_stitch(args.secondmacrolocation, well_obj.red_dir, registrationfile3, well_output_folder)
+    steps += FijiBatch.rename(f'{well_output_folder}/{end_file_name}',
+                              f'{output_folder}/{well_obj.well}_Red_Stitched.tif')
+    steps += FijiBatch.second_stitch(args.secondmacrolocation, well_obj.green_dir, registrationfile4,
+                                     well_output_folder)
+    steps += FijiBatch.rename(f'{well_output_folder}/{end_file_name}',
+                              f'{output_folder}/{well_obj.well}_Green_Stitched.tif')
+    return steps
+
+
+# Going through the well folders, skipping the ones that are already done, and stitching the rest
+# in a pool of --jobs workers (or, with --batch, in --jobs Fiji sessions that each get a share of the wells):
+stitcher = StitchWells.WellStitcher(args, output_folder, manifest, telemetry, imagej, ['Brightfield', 'Red', 'Green'],
+                                    stitch_well, batch_steps, register_well, fuse_well)
+stitcher.stitch_wells([WellFolder(folder, flat=args.index) for folder in wanted_folders], jobs, stitch_params)
 
 print("Done stitching images for folders " + ', '.join([well.name for well in wanted_folders]))
@@ -0,0 +1,213 @@
+# The parts of StitchImagesOnGreen.py and StitchImagesOnBF.py that don't depend on which channel the tiles are
+# registered on. Each script describes how to stitch a single well (and, for --batch, the macro lines for it, see
+# FijiBatch.py), and a WellStitcher takes care of the rest:
+# - skipping the wells whose stitched images are up to date (see ResultCache.py)
+# - stitching the rest in a pool of --jobs workers, or with --batch in --jobs Fiji sessions that each get a share of
+#   the wells
+# - reporting the wells that fail (Fiji failing, Fiji not writing its output, or registering or fusing in Python
+#   going wrong) without stopping the rest of the plate
+# - removing each well's temporary folder from the stitched images folder, whether the well worked or not
+# - converting the stitched images to OME-TIFFs (with --ometiff) and recording them in the manifest
+
+import glob
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import FijiBatch
+import WellIndex
+
+
+# Raised when Fiji exits normally but its output isn't there (e.g. after a macro error, which headless Fiji
+# only prints to stdout), with the last lines Fiji printed
+class MissingOutput(Exception):
+    def __init__(self, path, output):
+        super().__init__(path)
+        self.path = path
+        self.output = output
+
+
+# Checking that Fiji wrote a file, given Fiji's telemetry record from Telemetry.run()
+def check_fiji_output(path, record):
+    if not os.path.exists(path):
+        raise MissingOutput(path, record['stdout_tail'] + record['stderr_tail'])
+
+
+# Moving Fiji's fused image from a well's temporary folder to its final name, once it's checked that Fiji wrote it
+def move_fiji_image(source, destination, record):
+    check_fiji_output(source, record)
+    os.rename(source, destination)
+
+
+# Working out how many wells can be stitched at once. Each well gets its own Fiji process, so if a memory budget
+# was given we only start as many Fiji processes as fit in it. Returns the number of jobs and the Fiji command
+# (with its heap size, if one was given or worked out)
+def fiji_jobs(imagej, jobs, memory=None, jvm_memory=None):
+    jobs = max(1, jobs)
+    if memory is not None:
+        if jvm_memory is None:
+            jvm_memory = memory / jobs
+        jobs = max(1, min(jobs, int(memory // jvm_memory)))
+    if jvm_memory is not None:
+        imagej = imagej + f' --mem={int(jvm_memory * 1024)}m'
+    return jobs, imagej
+
+
+class WellStitcher:
+    # args are the stitching script's arguments. channels are the colors a well's stitched images are made from, in
+    # the order their tiles are listed for the manifest (e.g. ['Green', 'Red']). stitch_well(well_obj) stitches one
+    # well, batch_steps(well_obj) gives its macro lines for --batch, and register_well(well_obj) and
+    # fuse_well(well_obj, well_output_folder) register and fuse it in Python (with --registration/--fusion python)
+    def __init__(self, args, output_folder, manifest, telemetry, imagej, channels, stitch_well, batch_steps,
+                 register_well=None, fuse_well=None):
+        self.args = args
+        self.output_folder = output_folder
+        self.manifest = manifest
+        self.telemetry = telemetry
+        self.imagej = imagej
+        self.channels = channels
+        self.stitch_well = stitch_well
+        self.batch_steps = batch_steps
+        self.register_well = register_well
+        self.fuse_well = fuse_well
+
+    # The temporary folder Fiji writes a well's fused images into. Fiji always calls its fused image "img_t1_z1_c1",
+    # so each well gets its own, otherwise wells that are stitched at the same time would overwrite each other's
+    def well_output_folder(self, well_obj):
+        return f'{self.output_folder}/_{well_obj.well}_tmp'
+
+    # The stitched images that a well ends up with
+    def stitched_images(self, well_obj):
+        return [f'{self.output_folder}/{well_obj.well}_Red_Stitched.tif',
+                f'{self.output_folder}/{well_obj.well}_Green_Stitched.tif']
+
+    # The files that a well's stitched images are made from: its tiles, plus whichever macros are used
+    def well_inputs(self, well_obj):
+        inputs = []
+        directories = {'Brightfield': well_obj.bf_dir, 'Red': well_obj.red_dir, 'Green': well_obj.green_dir}
+        for channel in self.channels:
+            if self.args.index:
+                inputs += WellIndex.well_tiles(self.args.folderlocation, self.args.day, well_obj.well, channel)
+            else:
+                inputs += sorted(glob.glob(glob.escape(directories[channel]) +
+                                           f'/{well_obj.row} - {well_obj.column}(fld *).tif'))
+        if self.args.registration == 'fiji':
+            inputs.append(self.args.firstmacrolocation)
+        if self.args.fusion == 'fiji' or self.args.registration == 'fiji':
+            inputs.append(self.args.secondmacrolocation)
+        return inputs
+
+    # Rewriting the images of a well as OME-TIFFs (with --ometiff, see OmeTiff.py) and recording them in the
+    # manifest. Images fused in Python are already OME-TIFFs, and are left alone
+    def finish_well(self, well_obj):
+        if self.args.ometiff:
+            import OmeTiff
+            with self.telemetry.stage(well_obj.well, 'ometiff'):
+                for image in self.stitched_images(well_obj):
+                    OmeTiff.convert_file(image)
+        for image in self.stitched_images(well_obj):
+            self.manifest.record(image, well_obj.cache_key)
+
+    # Reporting why a well couldn't be stitched. Returns 'failed'
+    def failed(self, well_obj, error):
+        if isinstance(error, subprocess.CalledProcessError):
+            output = '\n'.join(text for text in [error.output, error.stderr] if text)
+            print(f'Fiji failed while stitching {well_obj.well} (exit code {error.returncode}):\n{output}')
+        elif isinstance(error, MissingOutput):
+            # Fiji can exit normally after a macro error, in which case its output is just missing
+            print(f'Fiji didn\'t write {error.path} for {well_obj.well}:\n' + '\n'.join(error.output))
+            self.telemetry.record(well_obj.well, 'rename', wall=0.0, exit=1, error=f'Missing {error.path}',
+                                  stdout_tail=error.output)
+        else:
+            # Registering or fusing in Python went wrong (already recorded by telemetry.stage())
+            print(f'Error while stitching {well_obj.well}: {error!r}')
+        return 'failed'
+
+    # Stitching a well and then recording its stitched images in the manifest. Returns 'done', or 'failed' (the rest
+    # of the wells are still stitched)
+    def stitch_and_record(self, well_obj):
+        try:
+            self.stitch_well(well_obj)
+            self.finish_well(well_obj)
+        except Exception as error:
+            return self.failed(well_obj, error)
+        finally:
+            shutil.rmtree(self.well_output_folder(well_obj), ignore_errors=True)
+        return 'done'
+
+    # Stitching a list of wells in a single Fiji session, then fusing them (with --fusion python) and tidying up
+    # the temporary folders of the wells. Returns a dictionary of well -> 'done' or 'failed'
+    def stitch_batch(self, batch_number, batch):
+        results = {}
+        try:
+            # A well that can't be registered is left out of the Fiji session
+            ready = []
+            for well_obj in batch:
+                if self.args.registration == 'python':
+                    try:
+                        self.register_well(well_obj)
+                    except Exception as error:
+                        results[well_obj.well] = self.failed(well_obj, error)
+                        continue
+                ready.append(well_obj)
+            wells = [(well_obj.well, self.batch_steps(well_obj)) for well_obj in ready]
+            if any(steps for _, steps in wells):
+                print(f'Stitching wells {", ".join([well_obj.well for well_obj in ready])} in one Fiji session')
+                # The macro is named after this process too, since several stitching scripts can share the output
+                # folder (e.g. WatchPlate.py with --jobs)
+                results.update(FijiBatch.run_batches(self.imagej, wells,
+                                                     f'{self.output_folder}/_batch{batch_number}_{os.getpid()}.ijm',
+                                                     self.telemetry))
+            else:
+                # Nothing left for Fiji to do
+                results.update({well_obj.well: 'done' for well_obj in ready})
+            # Each well is fused and recorded on its own, so one that fails doesn't stop the rest of the batch
+            for well_obj in ready:
+                if results[well_obj.well] != 'done':
+                    continue
+                try:
+                    if self.args.fusion == 'python':
+                        self.fuse_well(well_obj, self.well_output_folder(well_obj))
+                    self.finish_well(well_obj)
+                except Exception as error:
+                    results[well_obj.well] = self.failed(well_obj, error)
+        finally:
+            for well_obj in batch:
+                shutil.rmtree(self.well_output_folder(well_obj), ignore_errors=True)
+        return results
+
+    # Going through the wells, skipping the ones that are already done, and stitching the rest in a pool of jobs
+    # workers (or, with --batch, in jobs Fiji sessions that each get a share of the wells). Returns a dictionary of
+    # well -> 'done' or 'failed' for the wells that were stitched
+    def stitch_wells(self, well_objs, jobs, stitch_params):
+        wells_to_stitch = []
+        # (Whether there was a manifest before this run, since trusting the first existing well makes one)
+        had_manifest = os.path.exists(self.manifest.path)
+        for well_obj in well_objs:
+            # Working out the manifest key before stitching, so tiles that change in the meantime aren't counted
+            # as done
+            well_obj.cache_key = self.manifest.key(self.well_inputs(well_obj), stitch_params)
+            if all(self.manifest.is_current(image, well_obj.cache_key) for image in self.stitched_images(well_obj)):
+                print(f'Skipping well {well_obj.well}, stitched images are up to date')
+            elif self.args.trustexisting and not had_manifest and \
+                    all(os.path.exists(image) for image in self.stitched_images(well_obj)):
+                print(f'Skipping well {well_obj.well}, stitched images already exist')
+                for image in self.stitched_images(well_obj):
+                    self.manifest.record(image, well_obj.cache_key)
+            else:
+                wells_to_stitch.append(well_obj)
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            if self.args.batch:
+                batches = [wells_to_stitch[n::jobs] for n in range(jobs) if wells_to_stitch[n::jobs]]
+                results = {}
+                for batch_results in pool.map(self.stitch_batch, range(len(batches)), batches):
+                    results.update(batch_results)
+            else:
+                results = dict(zip([well_obj.well for well_obj in wells_to_stitch],
+                                   pool.map(self.stitch_and_record, wells_to_stitch)))
+        failed = sorted(well for well, status in results.items() if status != 'done')
+        if failed:
+            print('Failed to stitch wells ' + ', '.join(failed))
+        return results
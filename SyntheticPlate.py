@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Makes a fake plate export to test and time the pipeline without a real microscope export. Each well is a 4x3
+# snake-by-rows grid of tiles with 8.5% overlap (like our scans), cut out of one large image of synthetic nuclei.
+# Each tile is shifted from its place in the grid by a random few pixels, and those shifts are saved in
+# "synthetic_ground_truth.json" so the registration can be checked against them. The tiles are named like the
+# microscope names them, e.g. "A - 01(fld 01 wv 488 - GreenHS).tif", and written straight into the plate folder
+# ready for WellFolders.py.
+
+# Call should be in the format:
+# python3 SyntheticPlate.py [path/to/folder] --wells [number of wells, or A01 A02 etc.] --tilesize [pixels] \
+# --nuclei [nuclei per tile] --jitter [pixels] --seed [random seed] --labels --day [day for the label folders]
+
+# With --labels, the true label image of each green tile is also written to labelimages/{well}_Day{day}_labels/,
+# where the StarDist scripts would put theirs, so LabelMeasurements.py can be run without a model.
+
+import argparse
+import json
+import os
+
+import numpy as np
+import tifffile
+
+from TileRegistration import snake_grid
+
+
+ground_truth_name = 'synthetic_ground_truth.json'
+# The wavelength and color in the file names of each channel
+channels = {'Green': ('488', 'GreenHS'),
+            'Red': ('561', 'Orange'),
+            'Brightfield': ('TL-Brightfield', 'Orange')}
+
+
+def well_names(count):
+    return [f'{row}{column:02d}' for row in 'ABCDEFGH' for column in range(1, 13)][:count]
+
+
+def tile_name(well, field, channel):
+    wv, color = channels[channel]
+    return f'{well[0]} - {well[1:]}(fld {field:02d} wv {wv} - {color}).tif'
+
+
+# Drawing round-ish nuclei with soft edges onto an image, and their numbers onto a label image of the same size
+def draw_nuclei(image, labels, count, radius, rng):
+    height, width = image.shape
+    for number in range(1, count + 1):
+        r = rng.uniform(0.6, 1.4) * radius
+        y, x = rng.uniform(r, height - r), rng.uniform(r, width - r)
+        top, left = int(y - r - 2), int(x - r - 2)
+        yy, xx = np.mgrid[max(top, 0):min(int(y + r + 3), height), max(left, 0):min(int(x + r + 3), width)]
+        distance = np.hypot((yy - y) / rng.uniform(0.8, 1.2), xx - x) / r
+        nucleus = np.clip(1.5 - distance, 0, 1) * rng.uniform(1000, 3000)
+        inside = distance < 1
+        window = (slice(yy[0, 0], yy[-1, 0] + 1), slice(xx[0, 0], xx[0, -1] + 1))
+        image[window] = np.maximum(image[window], nucleus)
+        labels[window][inside] = number
+
+
+# Writing the tiles (and with labels, the true label images of the green tiles) of one well. Returns the true
+# (x, y) of each field, relative to field 1 like in a registered TileConfiguration file
+def make_well(folder, well, tile_size=512, columns=4, rows=3, overlap=0.085, jitter=6, nuclei=60, labels=False,
+              day=3, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    step = tile_size * (1 - overlap)
+    margin = jitter + 1
+    height = int(step * (rows - 1) + tile_size) + 2 * margin
+    width = int(step * (columns - 1) + tile_size) + 2 * margin
+    green = np.zeros((height, width), np.float32)
+    label_image = np.zeros((height, width), np.uint16)
+    draw_nuclei(green, label_image, nuclei * columns * rows, tile_size / 50, rng)
+    red = green * rng.uniform(0.2, 0.5)
+    yy, xx = np.mgrid[0:height, 0:width]
+    brightfield = 8000 + 2000 * np.sin(xx / width * np.pi) * np.cos(yy / height * np.pi) - 0.5 * green
+
+    if labels:
+        label_folder = os.path.join(folder, 'labelimages', f'{well}_Day{day}_labels')
+        os.makedirs(label_folder, exist_ok=True)
+    positions = []
+    for field, (column, row) in enumerate(snake_grid(columns, rows), start=1):
+        y = int(round(row * step)) + margin + int(rng.integers(-jitter, jitter + 1))
+        x = int(round(column * step)) + margin + int(rng.integers(-jitter, jitter + 1))
+        positions.append((x, y))
+        window = (slice(y, y + tile_size), slice(x, x + tile_size))
+        for channel, image in [('Green', green), ('Red', red), ('Brightfield', brightfield)]:
+            tile = image[window] + 100 + rng.normal(0, 20, (tile_size, tile_size))
+            tifffile.imwrite(os.path.join(folder, tile_name(well, field, channel)),
+                             np.clip(tile, 0, 65535).astype(np.uint16))
+        if labels:
+            name = os.path.splitext(tile_name(well, field, 'Green'))[0] + '_labels.tif'
+            tifffile.imwrite(os.path.join(label_folder, name), label_image[window])
+    return [(float(x - positions[0][0]), float(y - positions[0][1])) for x, y in positions]
+
+
+# Writing a whole fake plate and its ground truth file. Returns the ground truth
+def make_plate(folder, wells, seed=0, **options):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    truth = {'options': dict(options, seed=seed), 'positions': {}}
+    for well in wells:
+        truth['positions'][well] = make_well(folder, well, rng=rng, **options)
+    with open(os.path.join(folder, ground_truth_name), 'w') as file:
+        json.dump(truth, file, indent=1)
+    return truth
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Makes a fake plate of tiled images of nuclei with known tile '
+                                                 'positions, for testing and timing the pipeline',
+                                     usage='%(prog)s FOLDERPATH --wells [N or A01 A02 etc.]')
+    parser.add_argument('folderlocation', type=str, help='Folder to write the tiles to')
+    parser.add_argument('--wells', type=str, nargs='+', default=['4'],
+                        help='Number of wells (filled in from A01), or the wells to make')
+    parser.add_argument('--tilesize', type=int, default=512, help='Width and height of each tile in pixels')
+    parser.add_argument('--overlap', type=float, default=8.5, help='Tile overlap in percent')
+    parser.add_argument('--jitter', type=int, default=6,
+                        help='Largest shift in pixels of a tile from its place in the grid')
+    parser.add_argument('--nuclei', type=int, default=60, help='Number of nuclei per tile')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--labels', action='store_true', help='Also write the true label images of the green tiles')
+    parser.add_argument('--day', type=int, default=3, help='Day to put in the names of the label image folders')
+    args = parser.parse_args()
+
+    wells = well_names(int(args.wells[0])) if len(args.wells) == 1 and args.wells[0].isdigit() else args.wells
+    make_plate(args.folderlocation, wells, seed=args.seed, tile_size=args.tilesize, overlap=args.overlap / 100,
+               jitter=args.jitter, nuclei=args.nuclei, labels=args.labels, day=args.day)
+    print(f'Made {len(wells)} wells in {args.folderlocation}')
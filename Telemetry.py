@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# Keeps a record of where the time goes when stitching and segmenting a plate, and of what went wrong when a step
+# fails. Each stage of each well (a Fiji call, registering or fusing in Python, reading/predicting/writing an image
+# in StarDist) adds one JSON line to a "telemetry.jsonl" file in the output folder, with its wall time, CPU time,
+# peak memory, exit status and, for Fiji calls, the last lines Fiji wrote to stdout and stderr. Lines are only ever
+# appended (with one write each, like the manifest in ResultCache.py), so several threads or processes can share a
+# file.
+
+# Fiji calls are run through Telemetry.run(), which checks the exit code and raises subprocess.CalledProcessError
+# (with the end of its output) if Fiji failed, instead of finding out later when its output image is missing.
+
+# To see the slowest wells and stages of the latest run in one or more telemetry files:
+# python3 Telemetry.py [path/to/telemetry.jsonl] --top [number of slowest to list] --all
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+telemetry_name = 'telemetry.jsonl'
+# Scripts started by another script (e.g. the stitching script started by WatchPlate.py for each well) record their
+# stages under the run id in this environment variable, so a whole plate shows up as one run
+run_variable = 'CRANIUM_TELEMETRY_RUN'
+
+
+# Turning a ru_maxrss into MB. Linux gives it in KB, but macOS (where Fiji usually runs) gives it in bytes
+def rss_mb(maxrss):
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 1024
+
+
+# The exit code of a process from its wait status, or minus the signal that killed it (like subprocess does)
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# Running a shell command and getting its wall time, CPU time, peak memory (including anything it started and
+# waited for, e.g. the JVM started by the ImageJ launcher), exit code and the last lines of its stderr and stdout
+# (headless Fiji prints macro errors to stdout). Returns (record, stdout) where stdout is only kept in full if
+# keep_stdout is True
+def run_command(command, tail=20, keep_stdout=False):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout = []
+    stdout_tail = deque(maxlen=tail)
+
+    def read_stdout():
+        for line in process.stdout:
+            line = line.decode(errors='replace')
+            stdout_tail.append(line.rstrip())
+            if keep_stdout:
+                stdout.append(line)
+
+    reader = threading.Thread(target=read_stdout)
+    reader.start()
+    stderr = deque((line.decode(errors='replace').rstrip() for line in process.stderr), maxlen=tail)
+    reader.join()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = exit_code(status)
+    process.stdout.close()
+    process.stderr.close()
+    record = {'wall': time.perf_counter() - start, 'cpu': usage.ru_utime + usage.ru_stime,
+              'peak_rss_mb': rss_mb(usage.ru_maxrss), 'exit': process.returncode, 'stderr_tail': list(stderr),
+              'stdout_tail': list(stdout_tail)}
+    return record, ''.join(stdout)
+
+
+class Telemetry:
+    def __init__(self, path, script=''):
+        self.path = path
+        self.script = script
+        self.run_id = os.environ.get(run_variable) or f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+        self.lock = threading.Lock()
+
+    # Telemetry objects are passed to worker processes (e.g. by StarDistSharded.py), which keep the same run id
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != 'lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    # Adding a line for one stage of one well
+    def record(self, well, stage, **fields):
+        entry = {'run': self.run_id, 'script': self.script, 'host': platform.node(), 'pid': os.getpid(),
+                 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'well': well, 'stage': stage}
+        entry.update(fields)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+
+    # Timing a stage that runs in this process (e.g. registering or fusing in Python). The CPU time is this
+    # thread's (or the whole process's, for stages like TensorFlow that use their own threads), and the peak memory
+    # is the whole process's. Exceptions are recorded and then raised again
+    @contextmanager
+    def stage(self, well, stage, process_cpu=False, **fields):
+        clock = time.process_time if process_cpu else time.thread_time
+        start, cpu = time.perf_counter(), clock()
+        status = {'exit': 0}
+        try:
+            yield status
+        except BaseException as error:
+            status.update({'exit': 1, 'error': repr(error)})
+            raise
+        finally:
+            self.record(well, stage, wall=time.perf_counter() - start, cpu=clock() - cpu,
+                        peak_rss_mb=rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss), **fields, **status)
+
+    # Running a Fiji call (or any other shell command) for a stage of a well. Raises CalledProcessError with the end
+    # of stdout and stderr if it fails
+    def run(self, command, well, stage, tail=20):
+        record, _ = run_command(command, tail)
+        self.record(well, stage, **record)
+        if record['exit'] != 0:
+            raise subprocess.CalledProcessError(record['exit'], command, output='\n'.join(record['stdout_tail']),
+                                                stderr='\n'.join(record['stderr_tail']))
+        return record
+
+
+# Reading the lines of one or more telemetry files, only keeping the latest run unless all_runs is True
+def read_records(paths, all_runs=False):
+    records = []
+    for path in paths:
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    if not all_runs and records:
+        latest = max(records, key=lambda record: record['time'])['run']
+        records = [record for record in records if record['run'] == latest]
+    return records
+
+
+def summarize(records, top=10):
+    stages = {}
+    wells = {}
+    for record in records:
+        total = stages.setdefault(record['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max': 0.0, 'failed': 0,
+                                                    'peak_rss_mb': 0.0})
+        total['count'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record.get('cpu') or 0.0
+        total['max'] = max(total['max'], record['wall'])
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record.get('peak_rss_mb') or 0.0)
+        total['failed'] += record.get('exit', 0) != 0
+        wells[record['well']] = wells.get(record['well'], 0.0) + record['wall']
+
+    print(f'{"stage":<20}{"count":>7}{"total (s)":>11}{"mean (s)":>10}{"max (s)":>10}{"cpu (s)":>10}'
+          f'{"peak MB":>9}{"failed":>8}')
+    for stage, total in sorted(stages.items(), key=lambda item: item[1]['wall'], reverse=True):
+        print(f'{stage:<20}{total["count"]:>7}{total["wall"]:>11.1f}{total["wall"] / total["count"]:>10.2f}'
+              f'{total["max"]:>10.2f}{total["cpu"]:>10.1f}{total["peak_rss_mb"]:>9.0f}{total["failed"]:>8}')
+
+    print('\nSlowest wells:')
+    for well, wall in sorted(wells.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f'  {well:<20}{wall:>10.1f} s')
+
+    print('\nSlowest stages:')
+    for record in sorted(records, key=lambda record: record['wall'], reverse=True)[:top]:
+        print(f'  {record["well"]:<20}{record["stage"]:<20}{record["wall"]:>10.1f} s')
+
+    failures = [record for record in records if record.get('exit', 0) != 0]
+    if failures:
+        print('\nFailed:')
+        for record in failures:
+            print(f'  {record["well"]} {record["stage"]} (exit {record["exit"]}) {record.get("error", "")}')
+            for line in record.get('stdout_tail', []) + record.get('stderr_tail', []):
+                print(f'    {line}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows the slowest wells and stages in telemetry files written by '
+                                                 'the stitching and StarDist scripts',
+                                     usage='%(prog)s TELEMETRY.jsonl [TELEMETRY.jsonl ...] --top N --all')
+    parser.add_argument('paths', type=str, nargs='+', help='Telemetry files to read')
+    parser.add_argument('--top', type=int, default=10, help='How many of the slowest wells and stages to list')
+    parser.add_argument('--all', action='store_true', help='Include every run in the files, not just the latest')
+    args = parser.parse_args()
+
+    records = read_records(args.paths, args.all)
+    if not records:
+        print('No telemetry found')
+    else:
+        summarize(records, args.top)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Fuses the tiles of a well using a registered tile configuration file (e.g. "A01TileConBF.registered.txt" from the
+# first Fiji stitch), without having to start Fiji again for every channel. Every channel of a well uses the same
+# tile positions, so the blending weights are only worked out once and all the channels are fused in the same pass
+# over the tiles (one thread per channel). The fused image is worked out one band of rows at a time, each band
+# written into a memory-mapped TIFF as soon as it's done, so only one band of sums (plus the tiles that reach into
+# it) is ever held in memory rather than whole-well float copies. With ome_tiff=True, the memory-mapped image is then
+# rewritten as a tiled, compressed, pyramidal OME-TIFF (see OmeTiff.py).
+
+# Can also be run on its own:
+# python3 TileFusion.py [path/to/TileCon.registered.txt] [path/to/output.tif] --tiledir [folder with the tiles] \
+# --replace [text in the tile names to replace] [replacement] --ometiff
+
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+import OmeTiff
+
+
+# Lines in the tile configuration file look like "A - 01(fld 01 wv TL-Brightfield - Orange).tif; ; (0.0, 0.0)"
+tile_regex = re.compile(r'^(?P<name>[^;]+);[^;]*;\s*\((?P<x>[-\d.eE+]+),\s*(?P<y>[-\d.eE+]+)\)')
+
+
+# Reading a TileConfiguration file into a list of (file name, x, y)
+def read_tile_configuration(path):
+    tiles = []
+    with open(path, 'r') as file:
+        for line in file:
+            m = tile_regex.match(line.strip())
+            if m:
+                tiles.append((m.group('name').strip(), float(m.group('x')), float(m.group('y'))))
+    return tiles
+
+
+# Making the blending weights for a single tile. Like Fiji's linear blending, the weight goes smoothly from 1 in the
+# middle of the tile down to 0 at its edges over the outer 20% of the tile, so overlapping tiles fade into each other
+def blending_weights(shape, fraction=0.2, alpha=1.5):
+    ramps = []
+    for size in shape:
+        position = np.arange(size, dtype=np.float32)
+        distance = np.maximum(1, np.minimum(position, size - 1 - position))
+        relative = distance / max(1.0, size * fraction)
+        ramps.append(np.where(relative < 1, (np.cos((1 - relative) * np.pi) + 1) / 2, 1).astype(np.float32))
+    return np.outer(ramps[0], ramps[1]) ** alpha
+
+
+# Fusing one or more channels laid out the same way. positions is a list of (x, y) for each tile, tile_paths is a
+# list (one per channel) of lists of the tile images in the same order as positions, and output_paths has one
+# output TIFF per channel. The fused image is made band_rows rows at a time (by default the height of a tile)
+def fuse_tiles(positions, tile_paths, output_paths, ome_tiff=False, band_rows=None):
+    with tifffile.TiffFile(tile_paths[0][0]) as tif:
+        tile_shape = tif.series[0].shape
+        dtype = tif.series[0].dtype
+
+    # Turning the (subpixel) positions into pixel offsets from the top left corner of the fused image
+    offsets = np.round(np.array(positions)).astype(int)
+    offsets -= offsets.min(axis=0)
+    fused_shape = (int(offsets[:, 1].max()) + tile_shape[0], int(offsets[:, 0].max()) + tile_shape[1])
+
+    weights = blending_weights(tile_shape)
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+    else:
+        limits = np.finfo(dtype)
+    band_rows = band_rows or tile_shape[0]
+    # With ome_tiff=True, the image is fused into a temporary memory-mapped TIFF first
+    targets = [f'{os.path.dirname(path) or "."}/.{os.path.basename(path)}.fusing' if ome_tiff else path
+               for path in output_paths]
+    fused = [tifffile.memmap(target, shape=fused_shape, dtype=dtype, photometric='minisblack') for target in targets]
+
+    # Going down the image a band at a time. Each tile is read once, when the first band it reaches into comes up,
+    # and dropped after the last one
+    order = np.argsort(offsets[:, 1], kind='stable')
+    loaded = {}
+    next_tile = 0
+    with ThreadPoolExecutor(max_workers=len(output_paths)) as pool:
+        for top in range(0, fused_shape[0], band_rows):
+            bottom = min(top + band_rows, fused_shape[0])
+            while next_tile < len(order) and offsets[order[next_tile], 1] < bottom:
+                tile_number = order[next_tile]
+                loaded[tile_number] = list(pool.map(tifffile.imread, [paths[tile_number] for paths in tile_paths]))
+                next_tile += 1
+
+            weight_sum = np.zeros((bottom - top, fused_shape[1]), dtype=np.float32)
+            totals = [np.zeros_like(weight_sum) for _ in output_paths]
+
+            def add_tile(channel, tile, rows, region):
+                totals[channel][region] += tile[rows].astype(np.float32) * weights[rows]
+
+            # Adding the part of each tile in this band, for every channel at the same time
+            for tile_number, tiles in loaded.items():
+                x, y = offsets[tile_number]
+                rows = slice(max(top, y) - y, min(bottom, y + tile_shape[0]) - y)
+                region = (slice(y + rows.start - top, y + rows.stop - top), slice(x, x + tile_shape[1]))
+                weight_sum[region] += weights[rows]
+                list(pool.map(add_tile, range(len(output_paths)), tiles, [rows] * len(output_paths),
+                              [region] * len(output_paths)))
+
+            # Dividing by the total weight and writing the band of each channel
+            np.maximum(weight_sum, np.finfo(np.float32).tiny, out=weight_sum)
+
+            def write_band(channel):
+                totals[channel] /= weight_sum
+                if np.issubdtype(dtype, np.integer):
+                    np.rint(totals[channel], out=totals[channel])
+                np.clip(totals[channel], limits.min, limits.max, out=totals[channel])
+                fused[channel][top:bottom] = totals[channel]
+
+            list(pool.map(write_band, range(len(output_paths))))
+            for tile_number in [number for number in loaded if offsets[number, 1] + tile_shape[0] <= bottom]:
+                del loaded[tile_number]
+
+    for channel, image in enumerate(fused):
+        image.flush()
+        if ome_tiff:
+            OmeTiff.write_ome_tiff(output_paths[channel], image)
+    del fused, image
+    if ome_tiff:
+        for target in targets:
+            os.remove(target)
+
+
+# Fusing channels from a registered tile configuration file. channels is a list of
+# (folder with the tiles, text to replace in the tile names, replacement, output path), e.g.
+# (red_dir, 'TL-Brightfield', '561', 'A01_Red_Stitched.tif') to use the brightfield registration on the red tiles
+def fuse_registered(registration_file, channels, ome_tiff=False):
+    tiles = read_tile_configuration(registration_file)
+    positions = [(x, y) for _, x, y in tiles]
+    tile_paths = [[os.path.join(folder, name.replace(old, new)) for name, _, _ in tiles]
+                  for folder, old, new, _ in channels]
+    fuse_tiles(positions, tile_paths, [output for _, _, _, output in channels], ome_tiff)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fuses tiles with linear blending using the positions in a '
+                                                 'registered tile configuration file',
+                                     usage='%(prog)s REGISTRATIONFILE OUTPUTFILE --tiledir FOLDER '
+                                           '--replace OLD NEW')
+    parser.add_argument('registrationfile', type=str, help='Path of the TileConfiguration.registered.txt file')
+    parser.add_argument('output', type=str, help='Path of the fused image to write')
+    parser.add_argument('--tiledir', type=str, default=None,
+                        help='Folder with the tiles (defaults to the folder of the registration file)')
+    parser.add_argument('--replace', type=str, nargs=2, default=['', ''], metavar=('OLD', 'NEW'),
+                        help='Text to swap in the tile names, e.g. to fuse another channel')
+    parser.add_argument('--ometiff', action='store_true',
+                        help='Write a tiled, compressed, pyramidal OME-TIFF (see OmeTiff.py)')
+    args = parser.parse_args()
+
+    tiledir = args.tiledir if args.tiledir is not None else os.path.dirname(os.path.abspath(args.registrationfile))
+    fuse_registered(args.registrationfile, [(tiledir, args.replace[0], args.replace[1], args.output)], args.ometiff)
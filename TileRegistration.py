@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Registers the 4x3 grid of tiles for a well without Fiji. Does the same job as the first stitch in
+# FirstStitchBF.ijm/FirstStitchGreen.ijm ("Grid: snake by rows", "Right & Down", 8.5% overlap), but since we know
+# the layout and the overlap ahead of time, the shift between each pair of neighbouring tiles is only worked out
+# from the strips where they overlap (FFT phase correlation), rather than from the whole tiles.
+# The pairwise shifts are then put together with a global least squares fit, throwing out bad links with the same
+# thresholds used in the macros (regression 0.30, max/avg displacement 2.50, absolute displacement 3.50).
+# The output is a TileConfiguration file (and a .registered one) just like Fiji writes, so it can be used by
+# SecondStitch.ijm or TileFusion.py.
+
+# Call should be in the format:
+# python3 TileRegistration.py [path/to/tile/folder] "[file names, e.g. A - 01(fld {ii} wv TL-Brightfield - Orange).tif]" \
+# [TileConfiguration output name, e.g. A01TileConBF.txt]
+
+import argparse
+import os
+
+import numpy as np
+import tifffile
+
+
+# Getting the (column, row) of each tile for a grid in "snake by rows" order, starting right and going down
+def snake_grid(columns=4, rows=3):
+    order = []
+    for row in range(rows):
+        row_columns = range(columns) if row % 2 == 0 else range(columns - 1, -1, -1)
+        order.extend((column, row) for column in row_columns)
+    return order
+
+
+# Finding the candidate shifts of image b relative to image a (where a[y + dy, x + dx] lines up with b[y, x])
+# from the highest peaks of their phase correlation. Each peak is ambiguous because the FFT wraps around, so the
+# wrapped-around version of each shift is returned as well
+def phase_correlation(a, b, peaks=5):
+    a = a - a.mean()
+    b = b - b.mean()
+    cross_power = np.fft.rfft2(a) * np.conj(np.fft.rfft2(b))
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+    correlation = np.fft.irfft2(cross_power, s=a.shape)
+    best = np.argpartition(correlation.ravel(), -peaks)[-peaks:]
+    shifts = []
+    for y, x in zip(*np.unravel_index(best, correlation.shape)):
+        for dy in (y, y - a.shape[0]):
+            for dx in (x, x - a.shape[1]):
+                shifts.append((int(dy), int(dx)))
+    return shifts
+
+
+# The normalized cross correlation (Pearson r) of two tiles where they overlap, with b placed at (dy, dx)
+# relative to a. Returns -1 if they hardly overlap at all
+def overlap_correlation(a, b, dy, dx, min_pixels=100):
+    y0, y1 = max(0, dy), min(a.shape[0], dy + b.shape[0])
+    x0, x1 = max(0, dx), min(a.shape[1], dx + b.shape[1])
+    if (y1 - y0) * (x1 - x0) < min_pixels:
+        return -1.0
+    overlap_a = a[y0:y1, x0:x1].ravel()
+    overlap_b = b[y0 - dy:y1 - dy, x0 - dx:x1 - dx].ravel()
+    overlap_a = overlap_a - overlap_a.mean()
+    overlap_b = overlap_b - overlap_b.mean()
+    denominator = np.sqrt((overlap_a ** 2).sum() * (overlap_b ** 2).sum())
+    if denominator == 0:
+        return -1.0
+    return float((overlap_a * overlap_b).sum() / denominator)
+
+
+# Working out the shift of tile b relative to tile a when b is to the right of a (axis=1) or below it (axis=0).
+# Only a strip of twice the nominal overlap from each tile is used for the phase correlation, then every candidate
+# shift is checked on the full overlap and the best one is kept. Returns (dy, dx, r)
+def pairwise_shift(a, b, axis, overlap):
+    size = a.shape[axis]
+    strip = min(size, 2 * int(np.ceil(size * overlap)))
+    if axis == 1:
+        strip_a, strip_b = a[:, size - strip:], b[:, :strip]
+    else:
+        strip_a, strip_b = a[size - strip:, :], b[:strip, :]
+    best = (0, 0, -1.0)
+    for dy, dx in phase_correlation(strip_a, strip_b):
+        if axis == 1:
+            dx += size - strip
+        else:
+            dy += size - strip
+        r = overlap_correlation(a, b, dy, dx)
+        if r > best[2]:
+            best = (dy, dx, r)
+    return best
+
+
+# Putting all the pairwise shifts together into one position per tile with least squares. links is a list of
+# (tile i, tile j, dy, dx, r) meaning tile j sits at (dy, dx) from tile i. Links below the regression threshold are
+# never used, then the worst link is thrown out for as long as it disagrees too much with the fit, with the same test
+# as Fiji's global optimization: the worst error is over max_avg_displacement times the average error (and over
+# 0.95 px), or the average error is over absolute_displacement. Every tile is also loosely tied to its nominal grid
+# position so that tiles that lose all their links still end up where they should
+def global_optimization(links, nominal, regression_threshold=0.30, max_avg_displacement=2.50,
+                        absolute_displacement=3.50):
+    tiles = len(nominal)
+    links = [link for link in links if link[4] >= regression_threshold]
+    while True:
+        rows = [np.eye(tiles)[0] * 1000]
+        targets = [np.zeros(2)]
+        for i, j, dy, dx, _ in links:
+            row = np.zeros(tiles)
+            row[j], row[i] = 1, -1
+            rows.append(row)
+            targets.append(np.array([dy, dx], dtype=float))
+        for i in range(1, tiles):
+            row = np.zeros(tiles)
+            row[i], row[0] = 1e-3, -1e-3
+            rows.append(row)
+            targets.append((np.array(nominal[i]) - np.array(nominal[0])) * 1e-3)
+        positions = np.linalg.lstsq(np.array(rows), np.array(targets), rcond=None)[0]
+        if not links:
+            return positions
+
+        errors = np.array([np.hypot(*(positions[j] - positions[i] - (dy, dx))) for i, j, dy, dx, _ in links])
+        worst = int(errors.argmax())
+        average = errors.mean()
+        if (errors[worst] > max_avg_displacement * average and errors[worst] > 0.95) or \
+                average > absolute_displacement:
+            del links[worst]
+        else:
+            return positions
+
+
+# Registering a list of tiles (in snake order) and returning the (x, y) of each, with the first tile at (0, 0)
+def register_grid(tile_paths, columns=4, rows=3, overlap=0.085):
+    tiles = [tifffile.imread(path).astype(np.float32) for path in tile_paths]
+    height, width = tiles[0].shape
+    order = snake_grid(columns, rows)
+    index = {position: number for number, position in enumerate(order)}
+    nominal = [(row * height * (1 - overlap), column * width * (1 - overlap)) for column, row in order]
+
+    links = []
+    for (column, row), i in index.items():
+        if (column + 1, row) in index:
+            j = index[(column + 1, row)]
+            links.append((i, j) + pairwise_shift(tiles[i], tiles[j], 1, overlap))
+        if (column, row + 1) in index:
+            j = index[(column, row + 1)]
+            links.append((i, j) + pairwise_shift(tiles[i], tiles[j], 0, overlap))
+
+    positions = global_optimization(links, nominal)
+    positions = np.round(positions - positions[0])
+    return [(float(x), float(y)) for y, x in positions], [(x, y) for y, x in nominal]
+
+
+# Writing the positions out as a TileConfiguration file like the Fiji stitching plugin does
+def write_tile_configuration(path, names, positions):
+    with open(path, 'w') as file:
+        file.write('# Define the number of dimensions we are working on\ndim = 2\n\n# Define the image coordinates\n')
+        for name, (x, y) in zip(names, positions):
+            file.write(f'{name}; ; ({x}, {y})\n')
+
+
+# Doing the same as the first stitch macros: registering the tiles in directory matching file_names (with {ii}
+# standing for the field number) and writing both tilecon and its .registered.txt version into directory
+def register_well(directory, file_names, tilecon, columns=4, rows=3, overlap=0.085):
+    names = [file_names.replace('{ii}', f'{field:02d}') for field in range(1, columns * rows + 1)]
+    positions, nominal = register_grid([os.path.join(directory, name) for name in names], columns, rows, overlap)
+    write_tile_configuration(os.path.join(directory, tilecon), names, nominal)
+    write_tile_configuration(os.path.join(directory, tilecon.replace('.txt', '.registered.txt')), names, positions)
+    return positions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Registers a 4x3 snake-by-rows grid of tiles with phase '
+                                                 'correlation and writes a TileConfiguration file',
+                                     usage='%(prog)s FOLDERPATH FILENAMES TILECON')
+    parser.add_argument('folderlocation', type=str, help='Path of the folder with the tiles')
+    parser.add_argument('filenames', type=str, help='Tile file names, with {ii} in place of the field number')
+    parser.add_argument('tilecon', type=str, help='Name of the TileConfiguration file to write')
+    parser.add_argument('--overlap', type=float, default=8.5, help='Tile overlap in percent')
+    args = parser.parse_args()
+
+    register_well(args.folderlocation, args.filenames, args.tilecon, overlap=args.overlap / 100)
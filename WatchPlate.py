@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# Processes a plate while it is still being imaged. Instead of waiting for the whole export to finish before running
+# WellFolders.py, the stitching script and StarDist, this watches the folder the microscope is writing tiles into.
+# The tile names are parsed the same way WellFolders.py does (see WellIndex.py), and as soon as every field of every
+# color of a well has landed (12 fields x 3 colors by default) and none of them have changed size or modification
+# time for a few looks at the folder in a row, that well is:
+# - moved into its {well}_Day{day}/{color} folders like WellFolders.py does (or with --index, added to the well index)
+# - stitched by running the stitching script on just that well (with --wells)
+# - segmented by StarDist (its green tiles, into labelimages/{well}_Day{day}_labels like StarDistOnParentFolder.py).
+#   The model is only loaded once the first well is ready, and is kept for the rest of the plate
+# while the folder keeps being watched for the next wells.
+
+# Call should be in the format:
+# python3 WatchPlate.py [path/to/folder] [day] --interval [seconds between looks] --polls [looks a tile must not change
+# for] --fields [fields per well] --stitchscript [StitchImagesOnGreen.py or StitchImagesOnBF.py] \
+# --stitchoptions ["options for the stitching script"] --jobs [wells to stitch at once] --nostardist --index \
+# --measure [path/to/measurements.csv] --plate [plate name] --wells [wells to wait for] --idle [seconds]
+
+# It keeps going until --wells wells have been done, until no tiles have arrived for --idle seconds, or until it is
+# stopped with Ctrl-C (the wells that have already started are still finished). The stitching and StarDist scripts
+# skip wells that are already done (see ResultCache.py), so it can be stopped and started again at any time. Every
+# step of every well is recorded in the telemetry file in the stitched images folder (see Telemetry.py).
+
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import Telemetry
+import WellIndex
+
+
+scripts = os.path.dirname(os.path.abspath(__file__))
+
+
+# Keeps track of the tiles in the plate folder between looks, to find the wells whose tiles have all landed and
+# stopped changing
+class PlateWatcher:
+    def __init__(self, folder, fields=12, polls=2):
+        self.folder = folder
+        self.fields = fields
+        self.polls = polls
+        # Tile name -> (parsed name, (size, modification time), number of looks in a row it hasn't changed for)
+        self.tiles = {}
+        self.started = set()
+        self.last_change = time.time()
+
+    # Looking at the folder once. Returns the wells that are ready, as a dictionary of well -> its parsed tiles
+    def poll(self):
+        seen = {}
+        for file in os.scandir(self.folder):
+            tile = WellIndex.parse_tile_name(file.name) if file.name.endswith('.tif') else None
+            if tile is None or tile['well'] in self.started or not file.is_file():
+                continue
+            stat = file.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self.tiles.get(file.name)
+            if previous is not None and previous[1] == signature:
+                seen[file.name] = (tile, signature, previous[2] + 1)
+            else:
+                seen[file.name] = (tile, signature, 0)
+                self.last_change = time.time()
+        self.tiles = seen
+
+        wells = {}
+        for tile, signature, unchanged in seen.values():
+            wells.setdefault(tile['well'], []).append((tile, signature[0] > 0 and unchanged >= self.polls))
+        ready = {}
+        for well, tiles in wells.items():
+            found = {(tile['field'], tile['channel']) for tile, _ in tiles if 1 <= tile['field'] <= self.fields}
+            if len(found) == self.fields * len(WellIndex.colordict) and all(stable for _, stable in tiles):
+                ready[well] = sorted((tile for tile, _ in tiles), key=lambda tile: (tile['channel'], tile['field']))
+        for well in ready:
+            self.started.add(well)
+            for tile in ready[well]:
+                del self.tiles[tile['name']]
+        return ready
+
+    # The wells that have some tiles but aren't ready yet, and how many tiles each has
+    def waiting(self):
+        counts = {}
+        for tile, _, _ in self.tiles.values():
+            counts[tile['well']] = counts.get(tile['well'], 0) + 1
+        return counts
+
+
+# Moving a well's tiles into its {well}_Day{day}/{color} folders, the same way WellFolders.py does for a whole plate
+# (or with index=True, adding them to the well index and leaving them where they are)
+def organize_well(folder, day, well, tiles, index=False):
+    if index:
+        WellIndex.add_tiles(folder, day, tiles)
+        return
+    for color in ['Red', 'Green', 'Brightfield']:
+        os.makedirs(f'{folder}/{well}_Day{day}/{color}', exist_ok=True)
+    for tile in tiles:
+        os.rename(f'{folder}/{tile["name"]}', f'{folder}/{well}_Day{day}/{tile["channel"]}/{tile["name"]}')
+
+
+# Loads the StarDist model the first time a well needs it, and then segments one well at a time with it (the model
+# already uses all of the cores, so wells that are ready at the same time wait for each other)
+class WellSegmenter:
+    def __init__(self, folder, day, index=False, measure_csv=None, plate='', telemetry=None):
+        self.folder = folder
+        self.day = day
+        self.index = index
+        self.measure_csv = measure_csv
+        self.plate = plate
+        self.telemetry = telemetry
+        self.outputfolder = os.path.abspath(folder + '/labelimages')
+        self.model = None
+        self.lock = threading.Lock()
+
+    # Making the label images for a well's green tiles. Returns the number of images done
+    def segment(self, well):
+        if self.index:
+            images = WellIndex.well_tiles(self.folder, self.day, well, 'Green')
+        else:
+            images = sorted(glob.glob(glob.escape(f'{self.folder}/{well}_Day{self.day}/Green') + '/*.tif'))
+        outdir = f'{self.outputfolder}/{well}_Day{self.day}_labels'
+        os.makedirs(outdir, exist_ok=True)
+        savelocs = [outdir + '/' + os.path.splitext(os.path.basename(image))[0] + '_labels.tif' for image in images]
+        with self.lock:
+            if self.model is None:
+                from stardist.models import StarDist2D
+                print('Loading the StarDist model')
+                self.model = StarDist2D.from_pretrained('2D_versatile_fluo')
+            from LabelMeasurements import compact_csv
+            from StarDistPipeline import segment_images
+            done, _ = segment_images(self.model, images, savelocs, cache_folder=self.outputfolder,
+                                     measure_csv=self.measure_csv, plate=self.plate, telemetry=self.telemetry)
+            if self.measure_csv is not None:
+                compact_csv(self.measure_csv)
+        return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watches a folder that a plate is being imaged into, and organizes, '
+                                                 'stitches and segments each well as soon as all of its tiles '
+                                                 'have been written',
+                                     usage='%(prog)s FOLDERPATH DAYinteger --stitchoptions "OPTIONS"')
+    parser.add_argument('folderlocation', type=str, help='Folder the microscope is writing the tiles into')
+    parser.add_argument('day', type=int, help='Which day these pics are from (i.e. Day 3 would just be 3')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between looks at the folder')
+    parser.add_argument('--polls', type=int, default=2,
+                        help='Number of looks in a row that a tile\'s size and modification time must not change for '
+                             'before it counts as finished')
+    parser.add_argument('--fields', type=int, default=12, help='Number of fields imaged in each well')
+    parser.add_argument('--stitchscript', type=str, default='StitchImagesOnGreen.py',
+                        choices=['StitchImagesOnGreen.py', 'StitchImagesOnBF.py'], help='Stitching script to run')
+    parser.add_argument('--stitchoptions', type=str, default='',
+                        help='Options to pass on to the stitching script, in quotes (e.g. "--imagej path/to/imagej '
+                             '--registration python --fusion python")')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of wells to stitch at the same time')
+    parser.add_argument('--nostardist', action='store_true', help='Only organize and stitch the wells')
+    parser.add_argument('--index', action='store_true',
+                        help='Add the tiles to the well index (see WellIndex.py) instead of moving them into well '
+                             'folders, and pass --index on to the stitching script')
+    parser.add_argument('--measure', type=str, default=None, metavar='CSV',
+                        help='Also count the nuclei in each label image, adding a row per image to this CSV '
+                             '(see LabelMeasurements.py)')
+    parser.add_argument('--plate', type=str, default='', help='Plate name for the Metadata_Plate column of --measure')
+    parser.add_argument('--wells', type=int, default=None, help='Stop once this many wells have been done')
+    parser.add_argument('--idle', type=float, default=None,
+                        help='Stop once no tiles have arrived or changed for this many seconds')
+    args = parser.parse_args()
+
+    folder = os.path.abspath(args.folderlocation)
+    output_folder = f'{folder}/Stitched_Images_{args.day}'
+    os.makedirs(output_folder, exist_ok=True)
+    # One telemetry file for the whole plate, shared with the stitching script and StarDist
+    telemetry = Telemetry.Telemetry(f'{output_folder}/{Telemetry.telemetry_name}', 'WatchPlate')
+    # The stitching script of each well records its stages under this run too
+    os.environ[Telemetry.run_variable] = telemetry.run_id
+    stitch_options = shlex.split(args.stitchoptions) + (['--index'] if args.index else [])
+    segmenter = None if args.nostardist else WellSegmenter(folder, args.day, args.index, args.measure, args.plate,
+                                                           telemetry)
+
+    # Organizing, stitching and segmenting one well. Returns 'done', or 'failed' if it couldn't be stitched
+    def process_well(well, tiles):
+        with telemetry.stage(well, 'organize'):
+            organize_well(folder, args.day, well, tiles, args.index)
+        print(f'Stitching {well}')
+        command = [sys.executable, f'{scripts}/{args.stitchscript}', folder, str(args.day), '--wells', well,
+                   '--telemetry', telemetry.path] + stitch_options
+        status = 'done'
+        try:
+            telemetry.run(shlex.join(command), well, 'stitch_script')
+        except subprocess.CalledProcessError as error:
+            print(f'The stitching script failed for {well} (exit code {error.returncode}):\n{error.stderr}')
+            status = 'failed'
+        # The stitching script carries on past wells that Fiji failed on, so checking its images are there
+        if not all(os.path.exists(f'{output_folder}/{well}_{color}_Stitched.tif') for color in ['Red', 'Green']):
+            print(f'No stitched images for {well} (see {telemetry.path})')
+            status = 'failed'
+        if segmenter is not None:
+            print(f'Segmenting the green images of {well}')
+            segmenter.segment(well)
+        print(f'Finished {well}' + (' (stitching failed)' if status == 'failed' else ''))
+        return status
+
+    # Getting how a well went, without one well's error stopping the rest of the plate
+    def well_result(well, future):
+        try:
+            return future.result()
+        except Exception as error:
+            print(f'Error while processing {well}: {error!r}')
+            return 'failed'
+
+    watcher = PlateWatcher(folder, args.fields, args.polls)
+    running = {}
+    results = {}
+    print(f'Watching {folder} for finished wells (every {args.interval:g} s)')
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        try:
+            while True:
+                for well, tiles in sorted(watcher.poll().items()):
+                    print(f'All {len(tiles)} tiles of {well} are in')
+                    telemetry.record(well, 'tiles_ready', wall=0.0, tiles=len(tiles))
+                    running[well] = pool.submit(process_well, well, tiles)
+                for well in [well for well, future in running.items() if future.done()]:
+                    results[well] = well_result(well, running.pop(well))
+                if args.wells is not None and len(results) + len(running) >= args.wells:
+                    break
+                if args.idle is not None and time.time() - watcher.last_change > args.idle:
+                    print(f'No new tiles for {args.idle:g} s')
+                    break
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            print('Stopped watching, finishing the wells that have already started')
+        for well, future in running.items():
+            results[well] = well_result(well, future)
+
+    failed = sorted(well for well, status in results.items() if status != 'done')
+    if failed:
+        print('Failed to process wells ' + ', '.join(failed))
+    waiting = watcher.waiting()
+    if waiting:
+        print('Wells still missing tiles: ' + ', '.join(f'{well} ({count} tiles)'
+                                                        for well, count in sorted(waiting.items())))
+    print(f'Done {len(results)} wells')
@@ -2,10 +2,14 @@
 # Script that takes as input a folder of images from a scan, then makes a folder for each well,
 # containing a subfolder for each color in that well (Red, Green, Brightfield)
 # Run as WellFolders.py path/to/folder DayAsAnInteger
+# With --index, the images aren't moved at all. Instead their names are parsed into a small database in the folder
+# (see WellIndex.py) that the stitching and StarDist scripts can use with their own --index option.
 
 import argparse
-import re
 import os
+import sys
+
+import WellIndex
 
 
 # Getting the arguments from the command line
@@ -14,8 +18,16 @@ parser = argparse.ArgumentParser(description='Groups a folder full of images int
                                  usage='%(prog)s FOLDERPATH DAYinteger')
 parser.add_argument("folderlocation", type=str, help="Path of the folder to modify")
 parser.add_argument("day", type=int, help="Which day these pics are from (i.e. Day 3 would just be 3")
+parser.add_argument("--index", action="store_true",
+                    help="Index the images by well and color in well_index.sqlite instead of moving them")
 args = parser.parse_args()
 
+# In --index mode, only the file names are read and nothing is moved:
+if args.index:
+    indexed = WellIndex.build_index(args.folderlocation, args.day)
+    print(f'Indexed {indexed} images in {WellIndex.index_path(args.folderlocation)}')
+    sys.exit()
+
 # Getting a list of all of the images in the folder, then making a list of all the wells represented
 allimages = [file for file in os.scandir(args.folderlocation) if file.name.endswith('.tif')]
 wells = {image.name[0] + image.name[4:6] for image in allimages}
@@ -26,12 +38,9 @@ for well in wells:
         os.makedirs(f'{args.folderlocation}/{well}_Day{args.day}/{color}')
 
 # Moving each image file into the correct spot
-colordict = {'561': 'Red',
-             '488': 'Green',
-             'TL-Brightfield': 'Brightfield'}
+colordict = WellIndex.colordict
 for image in allimages:
-    m = re.match(r'^(?P<row>[A-Z]) - (?P<column>[0-9]{2})\(fld (?P<field>[0-9]{2}) '
-                 r'wv (?P<wv>[\w\-]*) - (?P<color>[\w]*)\).tif$', image.name)
+    m = WellIndex.tile_regex.match(image.name)
     color = colordict[m.group('wv')]
     well = m.group('row') + m.group('column')
     os.rename(image.path, f'{args.folderlocation}/{well}_Day{args.day}/{color}/{image.name}')
@@ -0,0 +1,100 @@
+# A virtual version of the folders made by WellFolders.py. Instead of moving every tile into
+# {well}_Day{day}/{color}/ folders, each file name in the plate folder is parsed once and stored in a small SQLite
+# database ("well_index.sqlite") in the plate folder, and the stitching and StarDist scripts ask it for a well's
+# tiles instead of listing folders. Made with "WellFolders.py path/to/folder Day --index".
+
+import os
+import re
+import sqlite3
+
+
+index_name = 'well_index.sqlite'
+
+# The same file name pattern and colors used by WellFolders.py
+tile_regex = re.compile(r'^(?P<row>[A-Z]) - (?P<column>[0-9]{2})\(fld (?P<field>[0-9]{2}) '
+                        r'wv (?P<wv>[\w\-]*) - (?P<color>[\w]*)\).tif$')
+colordict = {'561': 'Red',
+             '488': 'Green',
+             'TL-Brightfield': 'Brightfield'}
+
+
+# Splitting a tile's file name up into its parts, or None if it isn't a tile
+def parse_tile_name(name):
+    m = tile_regex.match(name)
+    if m is None or m.group('wv') not in colordict:
+        return None
+    return {'name': name,
+            'well': m.group('row') + m.group('column'),
+            'row': m.group('row'),
+            'column': m.group('column'),
+            'field': int(m.group('field')),
+            'wv': m.group('wv'),
+            'color': m.group('color'),
+            'channel': colordict[m.group('wv')]}
+
+
+def index_path(folder):
+    return os.path.join(folder, index_name)
+
+
+def connect(folder):
+    connection = sqlite3.connect(index_path(folder))
+    connection.execute('CREATE TABLE IF NOT EXISTS tiles (name TEXT PRIMARY KEY, well TEXT, row TEXT, '
+                       'col TEXT, field INTEGER, wv TEXT, color TEXT, channel TEXT, day INTEGER)')
+    connection.execute('CREATE INDEX IF NOT EXISTS tiles_by_well ON tiles (day, well, channel, field)')
+    return connection
+
+
+# Indexing the tiles in a folder for the given day. Only reads the folder listing, the tiles themselves are left
+# where they are. Whatever was indexed for that day before is replaced, so tiles that have since been renamed,
+# deleted or exported again aren't left behind in the index. Returns the number of tiles indexed
+def build_index(folder, day):
+    tiles = [parse_tile_name(file.name) for file in os.scandir(folder) if file.name.endswith('.tif')]
+    return add_tiles(folder, day, [tile for tile in tiles if tile is not None], whole_day=True)
+
+
+# Indexing some already parsed tiles (see parse_tile_name()) of a folder for the given day, e.g. one well at a time
+# as they are imaged (see WatchPlate.py). Anything indexed before for the same wells on that day (or with
+# whole_day=True, for every well on that day) is replaced. Returns the number of tiles indexed
+def add_tiles(folder, day, tiles, whole_day=False):
+    rows = [(tile['name'], tile['well'], tile['row'], tile['column'], tile['field'], tile['wv'], tile['color'],
+             tile['channel'], day) for tile in tiles]
+    with connect(folder) as connection:
+        if whole_day:
+            connection.execute('DELETE FROM tiles WHERE day = ?', (day,))
+        else:
+            connection.executemany('DELETE FROM tiles WHERE day = ? AND well = ?',
+                                   [(day, well) for well in sorted({tile['well'] for tile in tiles})])
+        connection.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.close()
+    return len(rows)
+
+
+# Getting the wells in the index for a day
+def wells(folder, day):
+    connection = connect(folder)
+    found = [well for well, in connection.execute('SELECT DISTINCT well FROM tiles WHERE day = ? ORDER BY well',
+                                                  (day,))]
+    connection.close()
+    return found
+
+
+# Getting the full paths of a well's tiles for one channel ('Red', 'Green' or 'Brightfield'), in field order
+def well_tiles(folder, day, well, channel):
+    connection = connect(folder)
+    names = [name for name, in connection.execute('SELECT name FROM tiles WHERE day = ? AND well = ? AND channel = ? '
+                                                  'ORDER BY field', (day, well, channel))]
+    connection.close()
+    return [os.path.join(folder, name) for name in names]
+
+
+# Getting the tiles of one channel for every well of a day, as a dictionary of "{well}_Day{day}" -> paths, i.e. the
+# same names that WellFolders.py would have given the well folders
+def tiles_by_well(folder, day, channel):
+    connection = connect(folder)
+    grouped = {}
+    for well, name in connection.execute('SELECT well, name FROM tiles WHERE day = ? AND channel = ? '
+                                         'ORDER BY well, field', (day, channel)):
+        grouped.setdefault(f'{well}_Day{day}', []).append(os.path.join(folder, name))
+    connection.close()
+    return grouped